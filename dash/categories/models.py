@@ -26,9 +26,13 @@ class Category(SmartModel):
                             help_text=_("The organization this category applies to"))
 
     def get_first_image(self):
-        cat_images = self.images.filter(is_active=True).exclude(image='')
-        if cat_images and cat_images.first().image:
-            return cat_images.first().image
+        if hasattr(self, '_active_images'):
+            cat_image = self._active_images[0] if self._active_images else None
+        else:
+            cat_image = self.images.filter(is_active=True).exclude(image='').first()
+
+        if cat_image and cat_image.image:
+            return cat_image.image
 
     def get_label_from_instance(self):
         label = str(self)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashblocks', '0008_dashblock_tag_names'),
+    ]
+
+    def populate_tag_names(apps, schema_editor):
+        DashBlock = apps.get_model("dashblocks", "DashBlock")
+
+        for obj in DashBlock.objects.exclude(tags=None).exclude(tags='').only('pk', 'tags'):
+            tag_names = list(OrderedDict.fromkeys(obj.tags.lower().split()))
+            DashBlock.objects.filter(pk=obj.pk).update(tag_names=tag_names)
+
+    def noop(apps, schema_editor):
+        pass
+
+    operations = [
+        migrations.RunPython(populate_tag_names, noop)
+    ]
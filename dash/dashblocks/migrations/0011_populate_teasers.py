@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dashblocks', '0010_dashblock_teasers'),
+    ]
+
+    def populate_teasers(apps, schema_editor):
+        DashBlock = apps.get_model("dashblocks", "DashBlock")
+
+        def teaser(field, length):
+            words = field.split(" ", length)
+            return field if len(words) < length else " ".join(words[:length]) + " ..."
+
+        for obj in DashBlock.objects.only('pk', 'content', 'summary'):
+            teasers = {}
+            for name in ('content', 'summary'):
+                field = getattr(obj, name)
+                if field:
+                    teasers['long_' + name] = teaser(field, 100)
+                    teasers['short_' + name] = teaser(field, 40)
+
+            DashBlock.objects.filter(pk=obj.pk).update(teasers=teasers)
+
+    def noop(apps, schema_editor):
+        pass
+
+    operations = [
+        migrations.RunPython(populate_teasers, noop)
+    ]
@@ -1,12 +1,30 @@
 from __future__ import unicode_literals
 
+import six
+
 from dash.orgs.models import Org
+from dash.utils import (
+    get_cache_version, invalidate_cache_version, truncate_words, TaggedContentMixin, TaggedManager
+)
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.indexes import GinIndex
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Prefetch
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from smartmin.models import SmartModel
 
 
+DASHBLOCKS_CACHE_KEY = 'org:%d:dashblocks:%s:%s'
+DASHBLOCKS_CACHE_TTL = 60 * 60 * 24
+
+# a token which is replaced whenever any dashblock, dashblock image or dashblock type changes
+DASHBLOCKS_CACHE_VERSION_KEY = 'dashblocks-cache-version'
+
+
 @python_2_unicode_compatible
 class DashBlockType(SmartModel):
     """
@@ -60,7 +78,7 @@ class DashBlockType(SmartModel):
 
 
 @python_2_unicode_compatible
-class DashBlock(SmartModel):
+class DashBlock(TaggedContentMixin, SmartModel):
     """
     A DashBlock is just a block of content, organized by type and priority.
     All fields are optional letting you use them for different things.
@@ -98,6 +116,14 @@ class DashBlock(SmartModel):
         blank=True, null=True, max_length=255,
         help_text=_("Any tags for this content block, separated by spaces, "
                     "can be used to do more advanced filtering, optional"))
+    tag_names = ArrayField(
+        models.CharField(max_length=255), default=list, blank=True, editable=False,
+        help_text=_("The normalized tags for this content block, which are "
+                    "indexed for filtering"))
+    teasers = JSONField(
+        default=dict, blank=True, editable=False,
+        help_text=_("The teasers for this content block, which are "
+                    "calculated when it is saved"))
     priority = models.IntegerField(
         default=0,
         help_text=_("The priority for this block, higher priority blocks "
@@ -107,25 +133,39 @@ class DashBlock(SmartModel):
         Org,
         help_text=_("The organization this content block belongs to"))
 
+    objects = TaggedManager()
+
     def teaser(self, field, length):
-        words = field.split(" ")
+        return truncate_words(field, length, " ...")
+
+    def calculate_teasers(self):
+        teasers = {}
+        for name in ('content', 'summary'):
+            field = getattr(self, name)
+            if field:
+                teasers['long_' + name] = self.teaser(field, 100)
+                teasers['short_' + name] = self.teaser(field, 40)
+        return teasers
 
-        if len(words) < length:
-            return field
-        else:
-            return " ".join(words[:length]) + " ..."
+    def get_teaser(self, name, field, length):
+        """
+        Gets the given teaser as calculated when this block was saved, or calculates it if it's missing
+        """
+        if name not in self.teasers:
+            return self.teaser(field, length)
+        return self.teasers[name]
 
     def long_content_teaser(self):
-        return self.teaser(self.content, 100)
+        return self.get_teaser('long_content', self.content, 100)
 
     def short_content_teaser(self):
-        return self.teaser(self.content, 40)
+        return self.get_teaser('short_content', self.content, 40)
 
     def long_summary_teaser(self):
-        return self.teaser(self.summary, 100)
+        return self.get_teaser('long_summary', self.summary, 100)
 
     def short_summary_teaser(self):
-        return self.teaser(self.summary, 40)
+        return self.get_teaser('short_summary', self.summary, 40)
 
     def space_tags(self):
         """
@@ -136,13 +176,80 @@ class DashBlock(SmartModel):
             self.tags = " " + self.tags.strip().lower() + " "
 
     def sorted_images(self):
+        if hasattr(self, '_sorted_images'):
+            return self._sorted_images
+
         return self.images.filter(is_active=True).order_by('-priority')
 
+    @classmethod
+    def get_for_org(cls, org, slug, tag=None):
+        """
+        Gets the active dashblocks of the given type for the given org as a list, with their type and active images
+        prefetched. These are cached until any dashblock, dashblock image or dashblock type changes.
+        :param org: the org
+        :param slug: the slug of the dashblock type
+        :param tag: an optional tag to filter dashblocks by
+        :return: the list of dashblocks, or None if there is no dashblock type with the given slug
+        """
+        return cls.get_for_org_many(org, [slug], tag)[slug]
+
+    @classmethod
+    def get_for_org_many(cls, org, slugs, tag=None):
+        """
+        Gets the active dashblocks of several types for the given org. Cached lists are fetched together, and the
+        dashblocks of any types which aren't cached are fetched with a single query.
+        :param org: the org
+        :param slugs: the slugs of the dashblock types
+        :param tag: an optional tag to filter dashblocks by
+        :return: dict of slugs to lists of dashblocks, or None for slugs with no dashblock type
+        """
+        version = get_dashblocks_cache_version()
+        cache_keys = {slug: DASHBLOCKS_CACHE_KEY % (org.pk, slug, version) for slug in slugs}
+
+        cached = cache.get_many(list(cache_keys.values()))
+        by_slug = {slug: cached[key] for slug, key in six.iteritems(cache_keys) if key in cached}
+
+        missing = [slug for slug in slugs if slug not in by_slug]
+        if missing:
+            existing = DashBlockType.objects.filter(slug__in=missing).values_list('slug', flat=True)
+            fetched = {slug: [] for slug in existing}
+
+            dashblocks = cls.objects.filter(dashblock_type__slug__in=list(fetched.keys()), org=org, is_active=True)
+            for dashblock in cls.prefetch_for_display(dashblocks).order_by('-priority'):
+                fetched[dashblock.dashblock_type.slug].append(dashblock)
+
+            to_cache = {cache_keys[slug]: fetched.get(slug, False) for slug in missing}
+            cache.set_many(to_cache, DASHBLOCKS_CACHE_TTL)
+
+            by_slug.update({slug: fetched.get(slug, False) for slug in missing})
+
+        results = {}
+        for slug in slugs:
+            dashblocks = by_slug[slug]
+            if dashblocks is False:
+                results[slug] = None
+            elif tag is not None:
+                tag = tag.strip().lower()
+                results[slug] = [d for d in dashblocks if tag in d.tag_names]
+            else:
+                results[slug] = dashblocks
+
+        return results
+
+    @classmethod
+    def prefetch_for_display(cls, dashblocks):
+        images = DashBlockImage.objects.filter(is_active=True).order_by('-priority')
+        return dashblocks.select_related('dashblock_type').prefetch_related(
+            Prefetch('images', queryset=images, to_attr='_sorted_images'))
+
     def __str__(self):
         if self.dashblock_type.has_title:
             return self.title
         return '%s - %d' % (self.dashblock_type, self.pk)
 
+    class Meta:
+        indexes = [GinIndex(fields=['tag_names'])]
+
 
 @python_2_unicode_compatible
 class DashBlockImage(SmartModel):
@@ -157,3 +264,14 @@ class DashBlockImage(SmartModel):
 
     def __str__(self):
         return self.image.url
+
+
+def get_dashblocks_cache_version():
+    return get_cache_version(DASHBLOCKS_CACHE_VERSION_KEY)
+
+
+@receiver((post_save, post_delete), sender=DashBlockType)
+@receiver((post_save, post_delete), sender=DashBlock)
+@receiver((post_save, post_delete), sender=DashBlockImage)
+def invalidate_dashblocks(sender, instance, **kwargs):
+    invalidate_cache_version(DASHBLOCKS_CACHE_VERSION_KEY)
@@ -1,11 +1,13 @@
 from __future__ import unicode_literals
 
 """
-This module offers one templatetag called ``load_dashblocks``.
+This module offers two templatetags called ``load_dashblocks`` and ``load_dashblocks_many``.
 
-``load_dashblocks`` does a query for all active DashBlock objects
+``load_dashblocks`` loads a list of all active DashBlock objects
 for the passed in DashBlockType and Org on request. (identified by the slug)
-You can then access that list within your context.
+You can then access that list within your context. The lists are cached
+until any DashBlock, DashBlockImage or DashBlockType changes, and each
+block's sorted_images are prefetched.
 
 It accepts 2 parameter:
 
@@ -35,6 +37,12 @@ Example usage::
     Note: You may also use the shortcut tag 'load_qbs'
     eg: {% load_qbs request.org "home_banner_blocks %}
 
+``load_dashblocks_many`` loads the DashBlocks for several slugs at once,
+fetching any which aren't cached with a single query, and accepts an
+optional tag to filter them by::
+
+    {% load_dashblocks_many request.org "home_banner_blocks" "home_footer_blocks" tag="featured" %}
+
 .. note::
 
     If you specify a slug that has no associated dash block, then an error message
@@ -42,7 +50,7 @@ Example usage::
     the value of the DASHBLOCK_STRING_IF_INVALID setting.
 
 """
-from dash.dashblocks.models import DashBlockType, DashBlock
+from dash.dashblocks.models import DashBlock
 from django import template
 from django.conf import settings
 
@@ -55,24 +63,35 @@ def load_dashblocks(context, org, slug, tag=None):
     if not org:
         return ''
 
-    try:
-        dashblock_type = DashBlockType.objects.get(slug=slug)
-    except DashBlockType.DoesNotExist:
+    dashblocks = DashBlock.get_for_org(org, slug, tag)
+    if dashblocks is None:
         default_invalid = '<b><font color="red">DashBlockType with slug: %s not found</font></b>'
         return getattr(settings, 'DASHBLOCK_STRING_IF_INVALID', default_invalid) % slug
 
-    dashblocks = DashBlock.objects.filter(dashblock_type=dashblock_type, org=org, is_active=True)
-    dashblocks = dashblocks.order_by('-priority')
-
-    # filter by our tag if one was specified
-    if tag is not None:
-        dashblocks = dashblocks.filter(tags__icontains=tag)
-
     context[slug] = dashblocks
 
     return ''
 
 
+@register.simple_tag(takes_context=True)
+def load_dashblocks_many(context, org, *slugs, **kwargs):
+    if not org:
+        return ''
+
+    invalid = ''
+    dashblocks_by_slug = DashBlock.get_for_org_many(org, slugs, kwargs.get('tag'))
+
+    for slug in slugs:
+        dashblocks = dashblocks_by_slug[slug]
+        if dashblocks is None:
+            default_invalid = '<b><font color="red">DashBlockType with slug: %s not found</font></b>'
+            invalid += getattr(settings, 'DASHBLOCK_STRING_IF_INVALID', default_invalid) % slug
+        else:
+            context[slug] = dashblocks
+
+    return invalid
+
+
 @register.simple_tag(takes_context=True)
 def load_qbs(context, org, slug, tag=None):
     return load_dashblocks(context, org, slug, tag)
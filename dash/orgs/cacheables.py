@@ -0,0 +1,114 @@
+from __future__ import unicode_literals
+
+"""
+Registry of per-org cached values which are kept warm by the refresh_org_cacheables org task
+"""
+
+import logging
+import time
+
+from collections import OrderedDict
+from dash.utils import get_cacheable
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+# registered cacheables by key template
+_registry = OrderedDict()
+
+
+class OrgCacheable(object):
+    """
+    A per-org cached value, e.g. an aggregate fetched from the backend
+    """
+    def __init__(self, key, cache_ttl, calculate, refresh_before=None, serializer=None):
+        """
+        :param key: the cache key template which is formatted with the org id, e.g. 'org:%d:stats'
+        :param cache_ttl: the cache TTL in seconds, or None for values which don't expire
+        :param calculate: the function which calculates the value for an org, e.g. foo(org)
+        :param refresh_before: the remaining TTL in seconds at which the value is refreshed, defaults to half the TTL
+        :param serializer: the serializer name used to store the value
+        """
+        if refresh_before is None:
+            refresh_before = cache_ttl // 2 if cache_ttl is not None else 0
+
+        self.key = key
+        self.cache_ttl = cache_ttl
+        self.calculate = calculate
+        self.refresh_before = refresh_before
+        self.serializer = serializer
+
+    def get_key(self, org):
+        return self.key % org.pk
+
+    def get(self, org, recalculate=False):
+        """
+        Gets the value for the given org, calculating it if it isn't cached
+        """
+        return get_cacheable(self.get_key(org), self.cache_ttl, lambda: self.calculate(org),
+                             recalculate=recalculate, serializer=self.serializer)
+
+    def needs_refresh(self, org):
+        """
+        Whether the value for the given org is missing or about to expire
+        """
+        ttl = cache.ttl(self.get_key(org))
+
+        # a value without an expiry never needs refreshing
+        return ttl is not None and ttl <= self.refresh_before
+
+    def refresh(self, org):
+        self.get(org, recalculate=True)
+
+
+def org_cacheable(key, cache_ttl, refresh_before=None, serializer=None):
+    """
+    Decorator to register a function which calculates a per-org cached value, e.g.
+
+        @org_cacheable('org:%d:stats', 60 * 60)
+        def get_stats(org):
+            ...
+
+        get_stats.get(org)
+
+    Cacheables should be declared in modules which are loaded by workers, e.g. the app's models or tasks module.
+    :param key: the cache key template which is formatted with the org id
+    :param cache_ttl: the cache TTL in seconds
+    :param refresh_before: the remaining TTL in seconds at which the value is refreshed
+    :param serializer: the serializer name used to store the value
+    """
+    def _org_cacheable(calculate):
+        cacheable = OrgCacheable(key, cache_ttl, calculate, refresh_before, serializer)
+        _registry[key] = cacheable
+        return cacheable
+    return _org_cacheable
+
+
+def get_org_cacheables():
+    return list(_registry.values())
+
+
+def refresh_org_cacheables_for_org(org):
+    """
+    Refreshes all registered cacheables for the given org which are missing or about to expire. A failing cacheable is
+    logged and doesn't prevent the others from being refreshed.
+    :param org: the org
+    :return: dict of the refreshed, failed and skipped keys, and how long each refresh took in seconds
+    """
+    results = {'refreshed': {}, 'failed': [], 'skipped': []}
+
+    for cacheable in get_org_cacheables():
+        start = time.time()
+        try:
+            if not cacheable.needs_refresh(org):
+                results['skipped'].append(cacheable.key)
+                continue
+
+            cacheable.refresh(org)
+            results['refreshed'][cacheable.key] = round(time.time() - start, 3)
+        except Exception:
+            logger.exception("Unable to refresh '%s' for org #%d" % (cacheable.key, org.pk))
+            results['failed'].append(cacheable.key)
+
+    return results
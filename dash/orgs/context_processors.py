@@ -1,6 +1,7 @@
 from __future__ import unicode_literals
 
 from collections import defaultdict
+from .models import get_group_perms
 
 
 class GroupPermWrapper(object):
@@ -10,15 +11,15 @@ class GroupPermWrapper(object):
 
         self.apps = dict()
         if self.group:
-            for perm in self.group.permissions.all().select_related('content_type'):
-                app_name = perm.content_type.app_label
+            for perm in get_group_perms(self.group):
+                app_name, codename = perm.split('.', 1)
                 app_perms = self.apps.get(app_name, None)
 
                 if not app_perms:
                     app_perms = defaultdict(lambda: False)
                     self.apps[app_name] = app_perms
 
-                app_perms[perm.codename] = True
+                app_perms[codename] = True
 
     def __getitem__(self, module_name):
         return self.apps.get(module_name, self.empty)
@@ -74,11 +75,8 @@ def set_org_processor(request):
     """
     if getattr(request, 'org', None):
         org = request.org
-        pattern_bg = org.backgrounds.filter(is_active=True, background_type='P')
-        pattern_bg = pattern_bg.order_by('-pk').first()
-        banner_bg = org.backgrounds.filter(is_active=True, background_type='B')
-        banner_bg = banner_bg.order_by('-pk').first()
+        backgrounds = org.get_backgrounds()
 
-        return dict(org=org, pattern_bg=pattern_bg, banner_bg=banner_bg)
+        return dict(org=org, pattern_bg=backgrounds.get('P'), banner_bg=backgrounds.get('B'))
     else:
         return dict()
@@ -5,7 +5,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 from timezone_field import TimeZoneFormField
-from .models import Org
+from .models import Org, get_org_hierarchy
 
 
 class CreateOrgLoginForm(forms.Form):
@@ -43,11 +43,18 @@ class OrgForm(forms.ModelForm):
             administrators = administrators.exclude(pk__lt=0)
             self.fields['administrators'].queryset = administrators
 
+        # choices are rendered from the cached org hierarchy, querysets are only used to validate submitted values
+        hierarchy = get_org_hierarchy()
+
         # Filter countries
-        self.fields['country'].queryset = Org.objects.filter(country__isnull=True, state__isnull=True)
+        countries = hierarchy.get_choices(hierarchy.country_ids)
+        self.fields['country'].queryset = Org.objects.countries()
+        self.fields['country'].choices = [('', self.fields['country'].empty_label)] + countries
 
         # Filter states
-        self.fields['state'].queryset = Org.objects.filter(state__isnull=True, country__isnull=False)
+        states = hierarchy.get_choices(hierarchy.state_ids)
+        self.fields['state'].queryset = Org.objects.states()
+        self.fields['state'].choices = [('', self.fields['state'].empty_label)] + states
 
     def clean_domain(self):
         domain = self.cleaned_data['domain'] or ""
@@ -1,15 +1,27 @@
 from __future__ import unicode_literals
 
+import copy
 import re
 import traceback
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import DisallowedHost
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 from django.utils import translation, timezone
 from django.utils.deprecation import MiddlewareMixin
-from .models import Org
+from .models import Org, get_org_cache_version
+
+
+# how long to cache which org a host resolves to (invalidated anyway when any org changes), and that a host doesn't
+# resolve to any org, which is kept short as any host can be requested
+ORG_HOST_CACHE_KEY = 'org-host:%s:%s'
+ORG_HOST_CACHE_TTL = 60 * 60 * 24
+ORG_HOST_MISS_CACHE_TTL = 60 * 5
+
+# the maximum number of hosts whose orgs are kept in each process
+ORG_HOST_MAX_CACHED = 1000
 
 
 ALLOW_NO_ORG = (
@@ -43,15 +55,69 @@ ALLOW_NO_ORG = (
     'orgs.orgbackend_update',
 )
 
+# orgs resolved from hosts in this process, for the current version of cached org lookups
+_host_orgs = {'version': None, 'orgs': {}}
+
 
 class SetOrgMiddleware(MiddlewareMixin):
     """
     Sets the org on the request, based on the subdomain
     """
     def process_request(self, request):
+        org = self.get_host_org(request)
+
+        if not request.user.is_anonymous():
+            request.user.set_org(org)
+
+        request.org = org
+
+        self.set_language(request, org)
+        self.set_timezone(request, org)
 
-        # try looking the domain level
-        host_parts = self.get_host_parts(request)
+    def get_host_org(self, request):
+        """
+        Gets the org for the request's host, using a map of hosts to orgs cached in this process and shared in the
+        cache, so that the database is only queried for hosts not seen since orgs last changed. Hosts which don't
+        resolve to an org aren't kept in this process.
+        """
+        host = self.get_host(request).lower()
+        version = get_org_cache_version()
+
+        if _host_orgs['version'] != version:
+            _host_orgs['orgs'] = {}
+            _host_orgs['version'] = version
+
+        host_key = '%s:%s' % (getattr(settings, 'HOSTNAME', ''), host)
+
+        if host_key in _host_orgs['orgs']:
+            org = _host_orgs['orgs'][host_key]
+        else:
+            cache_key = ORG_HOST_CACHE_KEY % (version, host_key)
+            org_id = cache.get(cache_key)
+            org = Org.objects.filter(pk=org_id, is_active=True).first() if org_id else None
+
+            if org_id is None or (org_id and not org):
+                org = self.find_host_org(request, host)
+                if org:
+                    cache.set(cache_key, org.pk, ORG_HOST_CACHE_TTL)
+                else:
+                    cache.set(cache_key, 0, ORG_HOST_MISS_CACHE_TTL)
+
+            if org and len(_host_orgs['orgs']) < ORG_HOST_MAX_CACHED:
+                _host_orgs['orgs'][host_key] = org
+
+        # each request gets its own copy of the cached org
+        if org:
+            org = copy.copy(org)
+            org.config = copy.deepcopy(org.config)
+
+        return org
+
+    def find_host_org(self, request, host):
+        """
+        Finds the org for the given host by its custom domain or subdomain
+        """
+        host_parts = self.get_host_parts(request, host)
 
         org = None
         # the domain is something like 'ureport.bi' or 'ureport.co.ug'
@@ -72,17 +138,11 @@ class SetOrgMiddleware(MiddlewareMixin):
 
         # no custom domain found, try the subdomain
         if not org:
-            subdomain = self.get_subdomain(request)
+            subdomain = self.get_subdomain(request, host_parts)
 
             org = Org.objects.filter(subdomain__iexact=subdomain, is_active=True).first()
 
-        if not request.user.is_anonymous():
-            request.user.set_org(org)
-
-        request.org = org
-
-        self.set_language(request, org)
-        self.set_timezone(request, org)
+        return org
 
     def set_language(self, request, org):
         """Set the current language from the org configuration."""
@@ -118,23 +178,29 @@ class SetOrgMiddleware(MiddlewareMixin):
             if url_name not in whitelist:
                 return HttpResponseRedirect(reverse(chooser_view))
 
-    def get_host_parts(self, request):
+    def get_host(self, request):
         host = 'localhost'
         try:
             host = request.get_host()
         except DisallowedHost:
             traceback.print_exc()
 
+        return host
+
+    def get_host_parts(self, request, host=None):
+        if host is None:
+            host = self.get_host(request)
+
         # does the host look like an IP? return []
         if re.match("^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$", host):
             return []
 
         return host.split('.')
 
-    def get_subdomain(self, request):
+    def get_subdomain(self, request, host_parts=None):
 
         subdomain = ""
-        parts = self.get_host_parts(request)
+        parts = self.get_host_parts(request) if host_parts is None else host_parts
         host_string = ".".join(parts)
 
         # we only look up subdomains for localhost and the configured hostname only
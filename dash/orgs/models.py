@@ -2,11 +2,19 @@ from __future__ import unicode_literals
 
 import json
 import random
+import six
+import time
 
+from collections import defaultdict
 from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.contrib.postgres.fields import JSONField
-from django.db import models
+from django.core.cache import cache
+from django.core.signals import setting_changed
+from django.db import connection, models, transaction
+from django.db.models import Exists, OuterRef
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.encoding import force_text, python_2_unicode_compatible
@@ -16,6 +24,7 @@ from smartmin.models import SmartModel
 from temba_client.v2 import TembaClient
 from timezone_field import TimeZoneField
 
+from dash.utils import get_cache_version, get_obj_cacheable, invalidate_cache_version
 from dash.utils.email import send_dash_email
 
 STATE = 1
@@ -28,8 +37,109 @@ BOUNDARY_CACHE_KEY = 'org:%d:boundaries'
 BOUNDARY_LEVEL_1_KEY = 'geojson:%d'
 BOUNDARY_LEVEL_2_KEY = 'geojson:%d:%s'
 
+ORG_BACKGROUNDS_CACHE_KEY = 'org:%d:backgrounds'
+ORG_BACKGROUNDS_CACHE_TTL = 60 * 60 * 24
+
+ORG_BACKEND_CACHE_KEY = 'org:%d:backend:%s:%s'
+ORG_BACKEND_CACHE_TTL = 60 * 60 * 24
+
+# a token which is replaced whenever any of an org's backends change to invalidate cached backends and their
+# connection details, including those cached under a slug the backend no longer has
+ORG_BACKENDS_VERSION_KEY = 'org:%d:backends-version'
+
+# a token which is replaced whenever any org changes to invalidate caches of org lookups
+ORG_CACHE_VERSION_KEY = 'org-cache-version'
+
+# the groups of the administrator, editor and viewer roles in orgs, in order of precedence
+ORG_GROUP_NAMES = ("Administrators", "Editors", "Viewers")
+
+# how long group permissions are cached in each process, which bounds how long changes made elsewhere take to apply
+GROUP_PERMS_CACHE_TTL = getattr(settings, 'GROUP_PERMS_CACHE_TTL', 60)
+
+
+# backend classes cached in this process by backend type
+_backend_classes = {}
+
+# backend instances cached in this process by org id and slug, with the version of the org's backends
+_org_backends = {}
+
+
+def get_backend_class(backend_type):
+    """
+    Gets the backend class for the given backend type, e.g. 'dash.orgs.backends.RapidProBackend'
+    """
+    backend_class = _backend_classes.get(backend_type)
+    if backend_class is None:
+        backend_class = _backend_classes[backend_type] = locate(backend_type)
+
+    return backend_class
+
+
+class OrgHierarchy(object):
+    """
+    An in-memory index of the country, state and district relationships between orgs
+    """
+    def __init__(self, orgs):
+        """
+        :param orgs: tuples of org id, name, country id and state id
+        """
+        self.names = {}
+        self.parent_ids = {}
+        self.child_ids = defaultdict(list)
+        self.country_ids = []
+        self.state_ids = []
+        self.district_ids = []
+
+        for org_id, name, country_id, state_id in orgs:
+            self.names[org_id] = name
+
+            if country_id is None and state_id is None:
+                self.country_ids.append(org_id)
+            elif state_id is None:
+                self.state_ids.append(org_id)
+                self.parent_ids[org_id] = country_id
+                self.child_ids[country_id].append(org_id)
+            elif country_id is None:
+                self.district_ids.append(org_id)
+                self.parent_ids[org_id] = state_id
+                self.child_ids[state_id].append(org_id)
+
+    def get_parent_id(self, org_id):
+        return self.parent_ids.get(org_id)
+
+    def get_child_ids(self, org_id):
+        return self.child_ids.get(org_id, [])
+
+    def get_choices(self, org_ids):
+        """
+        Gets form choices for the given org ids
+        """
+        return [(org_id, self.names[org_id]) for org_id in org_ids]
+
+
+# the org hierarchy cached in this process with the org cache version it was loaded at
+_org_hierarchy = {'version': None, 'hierarchy': None}
+
+
+def get_org_hierarchy():
+    """
+    Gets the org hierarchy, which is reloaded in each process whenever any org changes or the org cache version is
+    flushed
+    """
+    version = get_org_cache_version()
+
+    if _org_hierarchy['hierarchy'] is None or _org_hierarchy['version'] != version:
+        orgs = Org.objects.order_by('pk').values_list('pk', 'name', 'country_id', 'state_id')
+        _org_hierarchy['hierarchy'] = OrgHierarchy(orgs)
+        _org_hierarchy['version'] = version
+
+    return _org_hierarchy['hierarchy']
+
 
 class OrgManager(models.Manager):
+    def hierarchy(self):
+        return get_org_hierarchy()
+
     def countries(self):
         return self.get_queryset().filter(state__isnull=True, country__isnull=True)
 
@@ -103,36 +213,46 @@ class Org(SmartModel):
 
     @cached_property
     def is_state(self):
-        if self.country and self.state is None:
+        if self.country_id and self.state_id is None:
             return True
         return False
 
     @cached_property
     def is_district(self):
-        if self.country is None and self.state:
+        if self.country_id is None and self.state_id:
             return True
         return False
 
     def get_backend(self, backend_slug='rapidpro'):
-        backend = self.backends.filter(is_active=True, slug=backend_slug).first()
-        return locate(backend.backend_type)(backend=backend)
+        """
+        Gets the backend with the given slug, which is cached in this process until the org's backends change
+        """
+        key = (self.pk, backend_slug)
+        version = get_cache_version(ORG_BACKENDS_VERSION_KEY % self.pk)
 
+        cached = _org_backends.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
 
-    def get_config(self, name, default=None):
-        config = getattr(self, '_config', None)
+        backend = self.backends.filter(is_active=True, slug=backend_slug).first()
+        instance = get_backend_class(backend.backend_type)(backend=backend)
 
-        if config is None:
-            if not self.config:
-                return default
+        _org_backends[key] = (version, instance)
+        return instance
 
-            config = self.config
-            self._config = config
+    def get_config(self, name, default=None):
+        if not self.config:
+            return default
 
-        if name.find(".") == -1:
-            name = "common.%s" % name
+        key1, key2 = parse_config_name(name)
+        return self.config.get(key1, dict()).get(key2, default)
 
-        key1, key2 = name.split(".", 1)
-        return config.get(key1, dict()).get(key2, default)
+    def get_all_config(self):
+        """
+        Gets all config values as a flat dict of 'section.name' keys. Boolean fields declared in the config schema are
+        returned as booleans, and declared fields which aren't set are included as None.
+        """
+        return get_config_schema().flatten(self.config or dict())
 
     def set_config(self, name, value, commit=True):
         if not self.config:
@@ -140,16 +260,13 @@ class Org(SmartModel):
         else:
             config = self.config
 
-        if name.find(".") == -1:
-            name = "common.%s" % name
-        key1, key2 = name.split(".", 1)
+        key1, key2 = parse_config_name(name)
 
         if key1 not in config:
             config[key1] = dict()
 
         config[key1][key2] = value
         self.config = config
-        self._config = config
 
         if commit:
             self.save()
@@ -168,16 +285,39 @@ class Org(SmartModel):
         return org_users.distinct()
 
     def get_user_org_group(self, user):
-        if user in self.get_org_admins():
-            user._org_group = Group.objects.get(name="Administrators")
-        elif user in self.get_org_editors():
-            user._org_group = Group.objects.get(name="Editors")
-        elif user in self.get_org_viewers():
-            user._org_group = Group.objects.get(name="Viewers")
-        else:
-            user._org_group = None
+        """
+        Gets the group of the given user's role in this org, memoized on the user for each org
+        """
+        org_groups = getattr(user, '_org_groups', None)
+        if org_groups is None:
+            org_groups = user._org_groups = {}
+
+        if self.pk not in org_groups:
+            org_groups[self.pk] = self._fetch_user_org_group(user)
+
+        user._org_group = org_groups[self.pk]
+
+        return user._org_group
+
+    def _fetch_user_org_group(self, user):
+        """
+        Looks up the group of the given user's role in this org with a single query
+        """
+        if not user.pk:
+            return None
+
+        roles = User.objects.filter(pk=user.pk).annotate(
+            is_admin=Exists(Org.administrators.through.objects.filter(org_id=self.pk, user_id=OuterRef('pk'))),
+            is_editor=Exists(Org.editors.through.objects.filter(org_id=self.pk, user_id=OuterRef('pk'))),
+            is_viewer=Exists(Org.viewers.through.objects.filter(org_id=self.pk, user_id=OuterRef('pk'))),
+        ).values_list('is_admin', 'is_editor', 'is_viewer').first()
+
+        if roles:
+            for has_role, group_name in zip(roles, ORG_GROUP_NAMES):
+                if has_role:
+                    return get_group_by_name(group_name)
 
-        return getattr(user, '_org_group', None)
+        return None
 
     def get_user(self):
         user = self.administrators.filter(is_active=True).first()
@@ -197,15 +337,32 @@ class Org(SmartModel):
             raise ValueError("API host should not include API version, "
                              "e.g. http://example.com instead of http://example.com/api/v2")
 
-        api_token = ''
-        backend = self.backends.filter(is_active=True, slug='rapidpro').first()
+        backend = self.get_backend_connection('rapidpro')
         if backend:
-            api_token = backend.api_token
-            if backend.host:
-                host = backend.host
+            backend_host, api_token = backend
+            if backend_host:
+                host = backend_host
+        else:
+            api_token = ''
 
         return TembaClient(host, api_token, user_agent=agent)
 
+    def get_backend_connection(self, backend_slug):
+        """
+        Gets the host and API token of the active backend with the given slug, or None if there is no such backend
+        """
+        version = get_cache_version(ORG_BACKENDS_VERSION_KEY % self.pk)
+        cache_key = ORG_BACKEND_CACHE_KEY % (self.pk, version, backend_slug)
+        connection_details = cache.get(cache_key)
+
+        if connection_details is None:
+            backend = self.backends.filter(is_active=True, slug=backend_slug).values_list('host', 'api_token').first()
+            connection_details = (backend[0], backend[1]) if backend else ()
+
+            cache.set(cache_key, connection_details, ORG_BACKEND_CACHE_TTL)
+
+        return connection_details or None
+
     def build_host_link(self, user_authenticated=False):
         host_tld = getattr(settings, "HOSTNAME", 'locahost')
         is_secure = getattr(settings, 'SESSION_COOKIE_SECURE', False)
@@ -222,6 +379,26 @@ class Org(SmartModel):
             return prefix + host_tld
         return prefix + force_text(self.subdomain) + "." + host_tld
 
+    def get_backgrounds(self):
+        """
+        Gets the latest active background of each type as a dict of background type to background. This is cached for
+        the lifetime of this org instance and in the shared cache until the org's backgrounds change.
+        """
+        def calculate():
+            cache_key = ORG_BACKGROUNDS_CACHE_KEY % self.pk
+            backgrounds = cache.get(cache_key)
+
+            if backgrounds is None:
+                latest = OrgBackground.objects.filter(org=self, is_active=True)
+                latest = latest.order_by('background_type', '-pk').distinct('background_type')
+                backgrounds = {bg.background_type: bg for bg in latest}
+
+                cache.set(cache_key, backgrounds, ORG_BACKGROUNDS_CACHE_TTL)
+
+            return backgrounds
+
+        return get_obj_cacheable(self, '_backgrounds', calculate)
+
     def get_task_state(self, task_key):
         return TaskState.get_or_create(self, task_key)
 
@@ -246,6 +423,18 @@ class Org(SmartModel):
         return self.name
 
 
+def get_org_cache_version():
+    """
+    Gets the current version of cached org lookups, which changes whenever any org is saved or deleted
+    """
+    return get_cache_version(ORG_CACHE_VERSION_KEY)
+
+
+@receiver((post_save, post_delete), sender=Org)
+def invalidate_org_caches(sender, instance, **kwargs):
+    invalidate_cache_version(ORG_CACHE_VERSION_KEY)
+
+
 def get_org(obj):
     return getattr(obj, '_org', None)
 
@@ -269,6 +458,148 @@ def get_org_group(obj):
     return org_group
 
 
+# parsed config names cached in this process
+_config_names = {}
+
+
+def parse_config_name(name):
+    """
+    Parses a config name like 'rapidpro.api_token' into its section and key, with the section defaulting to 'common'
+    """
+    parsed = _config_names.get(name)
+    if parsed is None:
+        if name.find(".") == -1:
+            parsed = ("common", name)
+        else:
+            parsed = tuple(name.split(".", 1))
+
+        _config_names[name] = parsed
+
+    return parsed
+
+
+class OrgConfigField(object):
+    """
+    A config field declared in the ORG_CONFIG_FIELDS or BACKENDS_ORG_CONFIG_FIELDS setting
+    """
+    def __init__(self, section, name, field=None, read_only=False, superuser_only=False, **kwargs):
+        self.section = section
+        self.name = name
+        self.key = "%s.%s" % (section, name)
+        self.field_kwargs = field or dict()
+        self.read_only = read_only
+        self.superuser_only = superuser_only
+        self.is_boolean = name.startswith('has_') or name.startswith('is_')
+
+    def for_section(self, section):
+        return OrgConfigField(section, self.name, self.field_kwargs, self.read_only, self.superuser_only)
+
+    def is_visible(self, is_super):
+        return is_super or self.read_only or not self.superuser_only
+
+    def is_editable(self, is_super):
+        return is_super or (not self.superuser_only and not self.read_only)
+
+
+class OrgConfigSchema(object):
+    """
+    The org config fields declared in settings, compiled once per process
+    """
+    def __init__(self, common_fields, backend_fields):
+        self.common_fields = [OrgConfigField('common', **f) for f in common_fields]
+        self.backend_fields = [OrgConfigField('', **f) for f in backend_fields]
+        self.backend_boolean_names = {f.name for f in self.backend_fields if f.is_boolean}
+        self._sections = {}
+
+    def get_fields(self, backend_slugs=()):
+        """
+        Gets the common fields followed by the backend fields for each of the given backend slugs
+        """
+        fields = list(self.common_fields)
+        for backend_slug in backend_slugs:
+            fields += self.get_backend_fields(backend_slug)
+        return fields
+
+    def get_backend_fields(self, backend_slug):
+        fields = self._sections.get(backend_slug)
+        if fields is None:
+            fields = self._sections[backend_slug] = [f.for_section(backend_slug) for f in self.backend_fields]
+        return fields
+
+    def flatten(self, config):
+        values = {f.key: None for f in self.common_fields}
+        for section in config.keys():
+            if section != 'common':
+                values.update({f.key: None for f in self.get_backend_fields(section)})
+
+        common_booleans = {f.name for f in self.common_fields if f.is_boolean}
+
+        for section, section_config in six.iteritems(config):
+            booleans = common_booleans if section == 'common' else self.backend_boolean_names
+            for name, value in six.iteritems(section_config):
+                values["%s.%s" % (section, name)] = bool(value) if name in booleans else value
+
+        return values
+
+
+_config_schema = []
+
+
+def get_config_schema():
+    """
+    Gets the org config schema compiled from the ORG_CONFIG_FIELDS and BACKENDS_ORG_CONFIG_FIELDS settings
+    """
+    if not _config_schema:
+        _config_schema.append(OrgConfigSchema(getattr(settings, 'ORG_CONFIG_FIELDS', []),
+                                              getattr(settings, 'BACKENDS_ORG_CONFIG_FIELDS', [])))
+    return _config_schema[0]
+
+
+@receiver(setting_changed)
+def reset_config_schema(sender, setting, **kwargs):
+    if setting in ('ORG_CONFIG_FIELDS', 'BACKENDS_ORG_CONFIG_FIELDS'):
+        del _config_schema[:]
+
+
+# groups cached in this process by name
+_groups_by_name = {}
+
+
+def get_group_by_name(name):
+    """
+    Gets the group with the given name, which is cached for the lifetime of this process
+    """
+    group = _groups_by_name.get(name)
+    if group is None:
+        group = _groups_by_name[name] = Group.objects.get(name=name)
+
+    return group
+
+
+# group permissions cached in this process as group ids to tuples of expiry time and permissions
+_group_perms = {}
+
+
+def get_group_perms(group):
+    """
+    Gets the permissions of the given group as a frozenset of 'app_label.codename' strings
+    """
+    cached = _group_perms.get(group.pk)
+    if cached and cached[0] > time.time():
+        return cached[1]
+
+    perms = group.permissions.values_list('content_type__app_label', 'codename')
+    perms = frozenset('%s.%s' % (app_label, codename) for app_label, codename in perms)
+
+    _group_perms[group.pk] = (time.time() + GROUP_PERMS_CACHE_TTL, perms)
+    return perms
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_group_perms(sender, **kwargs):
+    _group_perms.clear()
+
+
 User.get_org = get_org
 User.set_org = set_org
 User.get_user_orgs = get_user_orgs
@@ -354,6 +685,15 @@ class OrgBackground(SmartModel):
     image = models.ImageField(upload_to='org_bgs', help_text=_("The image file"))
 
 
+@receiver((post_save, post_delete), sender=OrgBackground)
+def invalidate_org_backgrounds(sender, instance, **kwargs):
+    key = ORG_BACKGROUNDS_CACHE_KEY % instance.org_id
+
+    # deleted again once committed in case the old backgrounds were cached again in the meantime
+    cache.delete(key)
+    transaction.on_commit(lambda: cache.delete(key))
+
+
 class TaskState(models.Model):
     """
     Holds org specific state for a scheduled task
@@ -382,6 +722,50 @@ class TaskState(models.Model):
 
         return cls.objects.create(org=org, task_key=task_key)
 
+    @classmethod
+    def get_or_create_for_orgs(cls, org_ids, task_key):
+        """
+        Creates the states of a task for all of the given orgs which don't already have one. This is done with a
+        single insert which ignores states created concurrently, e.g. by a running task.
+        """
+        if not org_ids:
+            return
+
+        sql = """
+            INSERT INTO {table} (org_id, task_key, is_failing, is_disabled)
+            SELECT org_id, %s, FALSE, FALSE FROM unnest(%s::int[]) AS org_id
+            ON CONFLICT (org_id, task_key) DO NOTHING
+        """.format(table=cls._meta.db_table)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [task_key, list(org_ids)])
+
+    @classmethod
+    def start(cls, org, task_key, started_on):
+        """
+        Marks a task as started for the given org, unless it's disabled, creating its state if necessary. This is done
+        with a single upsert which returns the updated state.
+        """
+        table = cls._meta.db_table
+        fields = cls._meta.concrete_fields
+
+        sql = """
+            INSERT INTO {table} (org_id, task_key, started_on, is_failing, is_disabled)
+            VALUES (%s, %s, %s, FALSE, FALSE)
+            ON CONFLICT (org_id, task_key) DO UPDATE SET
+                started_on = CASE WHEN {table}.is_disabled THEN {table}.started_on ELSE EXCLUDED.started_on END,
+                ended_on = CASE WHEN {table}.is_disabled THEN {table}.ended_on ELSE NULL END
+            RETURNING {columns}
+        """.format(table=table, columns=", ".join(f.column for f in fields))
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [org.pk, task_key, started_on])
+            row = cursor.fetchone()
+
+        state = cls.from_db(connection.alias, [f.attname for f in fields], row)
+        state.org = org
+        return state
+
     @classmethod
     def get_failing(cls):
         return cls.objects.filter(org__is_active=True, is_failing=True)
@@ -420,3 +804,8 @@ class OrgBackend(SmartModel):
 
     class Meta:
         unique_together = ('org', 'slug')
+
+
+@receiver((post_save, post_delete), sender=OrgBackend)
+def invalidate_org_backend(sender, instance, **kwargs):
+    invalidate_cache_version(ORG_BACKENDS_VERSION_KEY % instance.org_id)
@@ -1,4 +1,4 @@
-from __future__ import unicode_literals
+from __future__ import division, unicode_literals
 
 import inspect
 import json
@@ -6,18 +6,23 @@ import logging
 import six
 import sys
 
-from celery import shared_task, signature
+from celery import current_app, group, shared_task, signature
+from dash.utils import chunks
 from django_redis import get_redis_connection
 from django.apps import apps
 from django.utils import timezone
 from functools import wraps
-from .models import Invitation
+from .cacheables import refresh_org_cacheables_for_org
+from .models import Invitation, TaskState
 
 
 ORG_TASK_LOCK_KEY = 'org-task-lock:%s:%s'
 
 logger = logging.getLogger(__name__)
 
+# the locks of org tasks currently running in this process
+_running_locks = {}
+
 
 @shared_task(track_started=True, name='send_invitation_email_task')
 def send_invitation_email_task(invitation_id):
@@ -26,18 +31,40 @@ def send_invitation_email_task(invitation_id):
 
 
 @shared_task
-def trigger_org_task(task_name, queue='celery'):
+def trigger_org_task(task_name, queue='celery', spread_over=None, batch_size=None):
     """
-    Triggers the given org task to be run for all active orgs
+    Triggers the given org task to be run for all active orgs. Sub-tasks are all published through one producer
+    connection.
     :param task_name: the full task name, e.g. 'myproj.myapp.tasks.do_stuff'
     :param queue: the name of the queue to send org sub-tasks to
+    :param spread_over: the number of seconds over which to stagger sub-tasks, e.g. the schedule interval
+    :param batch_size: the number of org sub-tasks to publish together as a group
+    :return: the number of org sub-tasks queued
     """
-    active_orgs = apps.get_model('orgs', 'Org').objects.filter(is_active=True)
-    for org in active_orgs:
-        sig = signature(task_name, args=[org.pk])
-        sig.apply_async(queue=queue)
+    org_ids = list(apps.get_model('orgs', 'Org').objects.filter(is_active=True).values_list('pk', flat=True))
+
+    # create any missing task states up front rather than in each sub-task
+    task_key = getattr(current_app.tasks.get(task_name), 'task_key', None)
+    if task_key:
+        TaskState.get_or_create_for_orgs(org_ids, task_key)
+
+    # sub-tasks are staggered in batches, or individually if no batch size is given
+    batches = list(chunks(org_ids, batch_size or 1))
+
+    with current_app.producer_or_acquire() as producer:
+        for b, batch in enumerate(batches):
+            options = dict(queue=queue, producer=producer)
+            if spread_over:
+                options['countdown'] = spread_over * b / len(batches)
+
+            if batch_size:
+                group([signature(task_name, args=[org_id]) for org_id in batch]).apply_async(**options)
+            else:
+                signature(task_name, args=[batch[0]]).apply_async(**options)
+
+    logger.info("Requested task '%s' for %d active orgs" % (task_name, len(org_ids)))
 
-    logger.info("Requested task '%s' for %d active orgs" % (task_name, len(active_orgs)))
+    return len(org_ids)
 
 
 def org_task(task_key, lock_timeout=None):
@@ -47,64 +74,118 @@ def org_task(task_key, lock_timeout=None):
     :param lock_timeout: the lock timeout in seconds
     """
     def _org_task(task_func):
+        num_task_args = get_num_task_args(task_func)
+
         def _decorator(org_id):
             org = apps.get_model('orgs', 'Org').objects.get(pk=org_id)
-            maybe_run_for_org(org, task_func, task_key, lock_timeout)
+            maybe_run_for_org(org, task_func, task_key, lock_timeout, num_task_args)
 
-        return shared_task(wraps(task_func)(_decorator))
+        return shared_task(wraps(task_func)(_decorator), task_key=task_key)
     return _org_task
 
 
-def maybe_run_for_org(org, task_func, task_key, lock_timeout):
+def get_num_task_args(task_func):
+    """
+    Gets the number of arguments taken by an org task function, which can be foo(org) or foo(org, since, until)
+    """
+    num_task_args = len(inspect.getargspec(task_func).args)
+    if num_task_args not in (1, 3):
+        raise ValueError("Task signature must be foo(org) or foo(org, since, until)")
+
+    return num_task_args
+
+
+def maybe_run_for_org(org, task_func, task_key, lock_timeout, num_task_args=None):
     """
     Runs the given task function for the specified org provided it's not already running
     :param org: the org
     :param task_func: the task function
     :param task_key: the task key
     :param lock_timeout: the lock timeout in seconds
+    :param num_task_args: the number of arguments taken by the task function
     """
+    if num_task_args is None:
+        num_task_args = get_num_task_args(task_func)
+
     r = get_redis_connection()
     key = ORG_TASK_LOCK_KEY % (org.pk, task_key)
-    if r.get(key):
+    lock = r.lock(key, timeout=lock_timeout)
+
+    # a single atomic attempt so that duplicate runs are skipped rather than queued behind the running task
+    if not lock.acquire(blocking=False):
         logger.warn("Skipping for org #%d as it is still running" % org.pk)
-    else:
-        with r.lock(key, timeout=lock_timeout):
-            state = org.get_task_state(task_key)
-            if state.is_disabled:
-                logger.info("Skipping for org #%d as task is marked disabled" % org.pk)
-                return
-
-            logger.info("Started for org #%d..." % org.pk)
-
-            prev_started_on = state.last_successfully_started_on
-            this_started_on = timezone.now()
-
-            state.started_on = this_started_on
-            state.ended_on = None
-            state.save(update_fields=('started_on', 'ended_on'))
-
-            num_task_args = len(inspect.getargspec(task_func).args)
-
-            try:
-                if num_task_args == 3:
-                    results = task_func(org, prev_started_on, this_started_on)
-                elif num_task_args == 1:
-                    results = task_func(org)
-                else:
-                    raise ValueError("Task signature must be foo(org) or foo(org, since, until)")  # pragma: no cover
-
-                state.ended_on = timezone.now()
-                state.last_successfully_started_on = this_started_on
-                state.last_results = json.dumps(results)
-                state.is_failing = False
-                state.save(update_fields=('ended_on', 'last_successfully_started_on', 'last_results', 'is_failing'))
-
-                logger.info("Succeeded for org #%d with result: %s" % (org.pk, json.dumps(results)))
-
-            except Exception:
-                state.ended_on = timezone.now()
-                state.last_results = None
-                state.is_failing = True
-                state.save(update_fields=('ended_on', 'last_results', 'is_failing'))
-
-                six.reraise(*sys.exc_info())  # re-raise with original stack trace
+        return
+
+    _running_locks[key] = lock
+    try:
+        run_for_org(org, task_func, task_key, num_task_args)
+    finally:
+        del _running_locks[key]
+        lock.release()
+
+
+def extend_org_task_lock(org, task_key, additional_time):
+    """
+    Extends the lock held by an org task which is running in this process, so that long-running tasks can keep their
+    lock without needing a pessimistically high lock timeout
+    :param org: the org
+    :param task_key: the task key
+    :param additional_time: the number of seconds to add to the lock's remaining time
+    """
+    key = ORG_TASK_LOCK_KEY % (org.pk, task_key)
+    lock = _running_locks.get(key)
+    if not lock:
+        raise ValueError("Task '%s' is not running for org #%d" % (task_key, org.pk))
+
+    lock.extend(additional_time)
+
+
+def run_for_org(org, task_func, task_key, num_task_args):
+    """
+    Runs the given task function for the specified org, recording its state
+    :param org: the org
+    :param task_func: the task function
+    :param task_key: the task key
+    :param num_task_args: the number of arguments taken by the task function
+    """
+    this_started_on = timezone.now()
+
+    state = TaskState.start(org, task_key, this_started_on)
+    if state.is_disabled:
+        logger.info("Skipping for org #%d as task is marked disabled" % org.pk)
+        return
+
+    logger.info("Started for org #%d..." % org.pk)
+
+    prev_started_on = state.last_successfully_started_on
+
+    try:
+        if num_task_args == 3:
+            results = task_func(org, prev_started_on, this_started_on)
+        else:
+            results = task_func(org)
+
+        state.ended_on = timezone.now()
+        state.last_successfully_started_on = this_started_on
+        state.last_results = json.dumps(results)
+        state.is_failing = False
+        state.save(update_fields=('ended_on', 'last_successfully_started_on', 'last_results', 'is_failing'))
+
+        logger.info("Succeeded for org #%d with result: %s" % (org.pk, json.dumps(results)))
+
+    except Exception:
+        state.ended_on = timezone.now()
+        state.last_results = None
+        state.is_failing = True
+        state.save(update_fields=('ended_on', 'last_results', 'is_failing'))
+
+        six.reraise(*sys.exc_info())  # re-raise with original stack trace
+
+
+@org_task('refresh-org-cacheables')
+def refresh_org_cacheables(org):
+    """
+    Refreshes the org's registered cacheables ahead of their expiry. Should be scheduled via trigger_org_task at an
+    interval shorter than the cacheables' refresh periods.
+    """
+    return refresh_org_cacheables_for_org(org)
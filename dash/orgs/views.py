@@ -2,11 +2,13 @@ from __future__ import unicode_literals
 
 import re
 
+from dash.utils import get_obj_cacheable
 from django import forms
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
 from django.core.validators import validate_email
@@ -16,7 +18,12 @@ from smartmin.views import (
     SmartCRUDL, SmartCreateView, SmartReadView, SmartUpdateView,
     SmartListView, SmartFormView, SmartTemplateView)
 from .forms import CreateOrgLoginForm, OrgForm
-from .models import Org, OrgBackground, Invitation, TaskState, OrgBackend
+from .models import Org, OrgBackground, Invitation, TaskState, OrgBackend, get_config_schema, get_group_perms
+from .models import get_org_cache_version
+
+
+ORG_CHOOSER_CACHE_KEY = 'org-chooser:%s:%s:%s'
+ORG_CHOOSER_CACHE_TTL = 60 * 60 * 24
 
 
 class OrgPermsMixin(object):
@@ -44,8 +51,6 @@ class OrgPermsMixin(object):
         return None
 
     def has_org_perm(self, permission):
-        (app_label, codename) = permission.split(".")
-
         if self.get_user().is_superuser:
             return True
 
@@ -55,8 +60,7 @@ class OrgPermsMixin(object):
         if self.org:
             org_group = self.get_user().get_org_group()
             if org_group:
-                if org_group.permissions.filter(content_type__app_label=app_label,
-                                                codename=codename).exists():
+                if permission in get_group_perms(org_group):
                     return True
 
         return False
@@ -130,11 +134,20 @@ class OrgCRUDL(SmartCRUDL):
         template_name = getattr(settings, 'SITE_CHOOSER_TEMPLATE', 'orgs/org_chooser.html')
 
         def get_context_data(self, **kwargs):
-            all_orgs = Org.objects.filter(is_active=True).order_by('name')
+            # orgs are cached until any org changes, separately for each host as their links depend on it
+            cache_key = ORG_CHOOSER_CACHE_KEY % (get_org_cache_version(),
+                                                 getattr(settings, 'HOSTNAME', ''),
+                                                 getattr(settings, 'SESSION_COOKIE_SECURE', False))
+            all_orgs = cache.get(cache_key)
+
+            if all_orgs is None:
+                all_orgs = list(Org.objects.filter(is_active=True).order_by('name'))
+
+                # populate a 'host' attribute on each org so we can link off to them
+                for org in all_orgs:
+                    org.host = org.build_host_link()
 
-            # populate a 'host' attribute on each org so we can link off to them
-            for org in all_orgs:
-                org.host = org.build_host_link()
+                cache.set(cache_key, all_orgs, ORG_CHOOSER_CACHE_TTL)
 
             return dict(orgs=all_orgs)
 
@@ -224,24 +237,24 @@ class OrgCRUDL(SmartCRUDL):
         success_url = '@orgs.org_home'
         fields = ('name',)
 
+        def get_config_fields(self):
+            """
+            Gets the config fields for this org and its active backends, fetching the backends only once per request
+            """
+            def calculate():
+                backends = self.get_object().backends.filter(is_active=True)
+                backends = backends.exclude(api_token='').exclude(api_token=None).values_list('slug', flat=True)
+                return get_config_schema().get_fields(backends)
+
+            return get_obj_cacheable(self, '_config_fields', calculate)
+
         def derive_fields(self):
             fields = super(OrgCRUDL.Edit, self).derive_fields()
             is_super = self.request.user.is_superuser
 
-            config_fields = getattr(settings, 'ORG_CONFIG_FIELDS', [])
-            for config_field in config_fields:
-                read_only = config_field.get('read_only', False)
-                if is_super or read_only or not config_field.get('superuser_only', False):
-                    fields.append("common.%s" % config_field['name'])
-
-            backends = self.get_object().backends.filter(is_active=True)
-            backends = backends.exclude(api_token='').exclude(api_token=None).values_list('slug', flat=True)
-            for backend_slug in backends:
-                config_fields = getattr(settings, 'BACKENDS_ORG_CONFIG_FIELDS', [])
-                for config_field in config_fields:
-                    read_only = config_field.get('read_only', False)
-                    if is_super or read_only or not config_field.get('superuser_only', False):
-                        fields.append("%s.%s" % (backend_slug, config_field['name']))
+            for config_field in self.get_config_fields():
+                if config_field.is_visible(is_super):
+                    fields.append(config_field.key)
             return fields
 
         def get_form(self):
@@ -249,38 +262,17 @@ class OrgCRUDL(SmartCRUDL):
             is_super = self.request.user.is_superuser
 
             # add all our configured org fields as well
-            config_fields = getattr(settings, 'ORG_CONFIG_FIELDS', [])
-            for config_field in config_fields:
-                read_only = config_field.get('read_only', False)
-                if is_super or read_only or not config_field.get('superuser_only', False):
-                    name = config_field['name']
-                    field_name = "common.%s" % name
-                    if name.startswith('has_') or name.startswith('is_'):
-                        form.fields[field_name] = forms.BooleanField(**config_field['field'])
+            for config_field in self.get_config_fields():
+                if config_field.is_visible(is_super):
+                    field_name = config_field.key
+                    if config_field.is_boolean:
+                        form.fields[field_name] = forms.BooleanField(**config_field.field_kwargs)
                     else:
-                        form.fields[field_name] = forms.CharField(**config_field['field'])
+                        form.fields[field_name] = forms.CharField(**config_field.field_kwargs)
 
-                    if not is_super and read_only:
+                    if not is_super and config_field.read_only:
                         form.fields[field_name].widget.attrs['readonly'] = 'readonly'
                         form.fields[field_name].required = False
-
-            backends = self.get_object().backends.filter(is_active=True)
-            backends = backends.exclude(api_token='').exclude(api_token=None).values_list('slug', flat=True)
-            for backend_slug in backends:
-                config_fields = getattr(settings, 'BACKENDS_ORG_CONFIG_FIELDS', [])
-                for config_field in config_fields:
-                    read_only = config_field.get('read_only', False)
-                    if is_super or read_only or not config_field.get('superuser_only', False):
-                        name = config_field['name']
-                        field_name = "%s.%s" % (backend_slug, name)
-                        if name.startswith('has_') or name.startswith('is_'):
-                            form.fields[field_name] = forms.BooleanField(**config_field['field'])
-                        else:
-                            form.fields[field_name] = forms.CharField(**config_field['field'])
-
-                        if not is_super and read_only:
-                            form.fields[field_name].widget.attrs['readonly'] = 'readonly'
-                            form.fields[field_name].required = False
             return form
 
         def pre_save(self, obj):
@@ -288,44 +280,20 @@ class OrgCRUDL(SmartCRUDL):
             cleaned = self.form.cleaned_data
             is_super = self.request.user.is_superuser
 
-            config_fields = getattr(settings, 'ORG_CONFIG_FIELDS', [])
-            for config_field in config_fields:
-                read_only = config_field.get('read_only', False)
-                if is_super or (not config_field.get('superuser_only', False) and not read_only):
-                    name = "common.%s" % config_field['name']
-                    obj.set_config(name, cleaned.get(name, None))
-
-            backends = self.get_object().backends.filter(is_active=True)
-            backends = backends.exclude(api_token='').exclude(api_token=None).values_list('slug', flat=True)
-            for backend_slug in backends:
-                config_fields = getattr(settings, 'BACKENDS_ORG_CONFIG_FIELDS', [])
-                for config_field in config_fields:
-                    read_only = config_field.get('read_only', False)
-                    if is_super or (not config_field.get('superuser_only', False) and not read_only):
-                        name = "%s.%s" % (backend_slug, config_field['name'])
-                        obj.set_config(name, cleaned.get(name, None))
+            for config_field in self.get_config_fields():
+                if config_field.is_editable(is_super):
+                    obj.set_config(config_field.key, cleaned.get(config_field.key, None), commit=False)
             return obj
 
         def derive_initial(self):
             initial = super(OrgCRUDL.Edit, self).derive_initial()
+
+            config = self.object.get_all_config()
             is_super = self.request.user.is_superuser
 
-            config_fields = getattr(settings, 'ORG_CONFIG_FIELDS', [])
-            for config_field in config_fields:
-                read_only = config_field.get('read_only', False)
-                if is_super or read_only or not config_field.get('superuser_only', False):
-                    name = "common.%s" % config_field['name']
-                    initial[name] = self.object.get_config(name)
-
-            backends = self.get_object().backends.filter(is_active=True)
-            backends = backends.exclude(api_token='').exclude(api_token=None).values_list('slug', flat=True)
-            for backend_slug in backends:
-                config_fields = getattr(settings, 'BACKENDS_ORG_CONFIG_FIELDS', [])
-                for config_field in config_fields:
-                    read_only = config_field.get('read_only', False)
-                    if is_super or read_only or not config_field.get('superuser_only', False):
-                        name = "%s.%s" % (backend_slug, config_field['name'])
-                        initial[name] = self.object.get_config(name)
+            for config_field in self.get_config_fields():
+                if config_field.is_visible(is_super):
+                    initial[config_field.key] = config.get(config_field.key)
 
             return initial
 
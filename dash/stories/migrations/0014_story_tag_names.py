@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:46
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0013_auto_20170301_0914'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='tag_names',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=255), blank=True, default=list, editable=False, help_text='The normalized tags for this story, which are indexed for filtering', size=None),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['tag_names'], name='stories_sto_tag_nam_6268c5_gin'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0014_story_tag_names'),
+    ]
+
+    def populate_tag_names(apps, schema_editor):
+        Story = apps.get_model("stories", "Story")
+
+        for obj in Story.objects.exclude(tags=None).exclude(tags='').only('pk', 'tags'):
+            tag_names = list(OrderedDict.fromkeys(obj.tags.lower().split()))
+            Story.objects.filter(pk=obj.pk).update(tag_names=tag_names)
+
+    def noop(apps, schema_editor):
+        pass
+
+    operations = [
+        migrations.RunPython(populate_tag_names, noop)
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:52
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0015_populate_tag_names'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='teasers',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, default=dict, editable=False, help_text='The teasers for this story, which are calculated when it is saved'),
+        ),
+    ]
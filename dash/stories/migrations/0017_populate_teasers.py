@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0016_story_teasers'),
+    ]
+
+    def populate_teasers(apps, schema_editor):
+        Story = apps.get_model("stories", "Story")
+
+        def teaser(field, length):
+            if not field:
+                return ""
+            words = field.split(" ", length)
+            return field if len(words) < length else " ".join(words[:length]) + " .."
+
+        for obj in Story.objects.only('pk', 'content', 'summary'):
+            field = obj.summary if obj.summary else obj.content
+            teasers = {'long': teaser(field, 100), 'short': teaser(field, 40)}
+
+            Story.objects.filter(pk=obj.pk).update(teasers=teasers)
+
+    def noop(apps, schema_editor):
+        pass
+
+    operations = [
+        migrations.RunPython(populate_teasers, noop)
+    ]
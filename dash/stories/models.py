@@ -1,13 +1,17 @@
 from __future__ import unicode_literals
 
-from dash.categories.models import Category
+from dash.categories.models import Category, CategoryImage
 from dash.orgs.models import Org
+from dash.utils import get_obj_cacheable, truncate_words, TaggedContentMixin, TaggedManager
+from django.contrib.postgres.fields import ArrayField, JSONField
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
+from django.db.models import Prefetch, prefetch_related_objects
 from django.utils.translation import ugettext_lazy as _
 from smartmin.models import SmartModel
 
 
-class Story(SmartModel):
+class Story(TaggedContentMixin, SmartModel):
     title = models.CharField(
         max_length=255,
         help_text=_("The title for this story"))
@@ -37,6 +41,14 @@ class Story(SmartModel):
         help_text=_("Any tags for this story, separated by spaces, can be "
                     "used to do more advanced filtering, optional"))
 
+    tag_names = ArrayField(
+        models.CharField(max_length=255), default=list, blank=True, editable=False,
+        help_text=_("The normalized tags for this story, which are indexed for filtering"))
+
+    teasers = JSONField(
+        default=dict, blank=True, editable=False,
+        help_text=_("The teasers for this story, which are calculated when it is saved"))
+
     category = models.ForeignKey(
         Category, null=True, blank=True,
         help_text=_("The category for this story"))
@@ -45,6 +57,8 @@ class Story(SmartModel):
         Org,
         help_text=_("The organization this story belongs to"))
 
+    objects = TaggedManager()
+
     @classmethod
     def format_audio_link(cls, link):
         formatted_link = link
@@ -70,22 +84,25 @@ class Story(SmartModel):
     def teaser(self, field, length):
         if not field:
             return ""
-        words = field.split(" ")
+        return truncate_words(field, length, " ..")
 
-        if len(words) < length:
-            return field
-        else:
-            return " ".join(words[:length]) + " .."
+    def calculate_teasers(self):
+        field = self.summary if self.summary else self.content
+        return {'long': self.teaser(field, 100), 'short': self.teaser(field, 40)}
+
+    def get_teaser(self, name):
+        """
+        Gets the given teaser as calculated when this story was saved, or calculates it if it's missing
+        """
+        if name not in self.teasers:
+            return self.calculate_teasers()[name]
+        return self.teasers[name]
 
     def long_teaser(self):
-        if self.summary:
-            return self.teaser(self.summary, 100)
-        return self.teaser(self.content, 100)
+        return self.get_teaser('long')
 
     def short_teaser(self):
-        if self.summary:
-            return self.teaser(self.summary, 40)
-        return self.teaser(self.content, 40)
+        return self.get_teaser('short')
 
     def get_written_by(self):
         if self.written_by:
@@ -96,32 +113,70 @@ class Story(SmartModel):
             return full_name.strip()
 
     def get_featured_images(self):
+        if hasattr(self, '_featured_images'):
+            return self._featured_images
+
         return self.images.filter(is_active=True).exclude(image='')
 
     def get_category_image(self):
-        cat_image = None
-        if self.category and self.category.is_active:
-            cat_image = self.category.get_first_image()
+        def calculate():
+            cat_image = None
+            if self.category and self.category.is_active:
+                cat_image = self.category.get_first_image()
+
+            if not cat_image:
+                featured_images = self.get_featured_images()
+                if featured_images:
+                    cat_image = featured_images[0].image
 
-        if not cat_image:
-            if self.get_featured_images():
-                cat_image = self.get_featured_images()[0].image
+            return cat_image
 
-        return cat_image
+        return self._get_image_cacheable('_category_image', calculate)
 
     def get_image(self):
-        cat_image = None
-        if self.get_featured_images():
-            cat_image = self.get_featured_images()[0].image
+        def calculate():
+            cat_image = None
+            featured_images = self.get_featured_images()
+            if featured_images:
+                cat_image = featured_images[0].image
 
-        if not cat_image:
-            if self.category and self.category.is_active:
-                cat_image = self.category.get_first_image()
+            if not cat_image:
+                if self.category and self.category.is_active:
+                    cat_image = self.category.get_first_image()
+
+            return cat_image
+
+        return self._get_image_cacheable('_image', calculate)
+
+    def _get_image_cacheable(self, attr_name, calculate):
+        # images are only memoized when they've been prefetched, as otherwise they should reflect the database
+        if hasattr(self, '_featured_images'):
+            return get_obj_cacheable(self, attr_name, calculate)
+
+        return calculate()
+
+    @classmethod
+    def prefetch_images(cls, stories):
+        """
+        Prefetches the featured images of the given stories, and their categories with active images, so that their
+        display images can be resolved with a constant number of queries
+        :param stories: the stories
+        :return: the stories
+        """
+        featured_images = StoryImage.objects.filter(is_active=True).exclude(image='').order_by('pk')
+        category_images = CategoryImage.objects.filter(is_active=True).exclude(image='').order_by('pk')
 
-        return cat_image
+        prefetch_related_objects(
+            stories,
+            Prefetch('images', queryset=featured_images, to_attr='_featured_images'),
+            'category',
+            Prefetch('category__images', queryset=category_images, to_attr='_active_images')
+        )
+        return stories
 
     class Meta:
         verbose_name_plural = _("Stories")
+        indexes = [GinIndex(fields=['tag_names'])]
 
 
 class StoryImage(SmartModel):
@@ -4,6 +4,7 @@ from dash.categories.fields import CategoryChoiceField
 from dash.orgs.views import OrgPermsMixin, OrgObjPermsMixin
 from django import forms
 from django.core.urlresolvers import reverse
+from django.db.models import Count
 from django.utils.translation import ugettext_lazy as _
 from smartmin.views import SmartCRUDL, SmartCreateView, SmartListView, SmartUpdateView
 from .models import Category, Story, StoryImage
@@ -66,11 +67,11 @@ class StoryCRUDL(SmartCRUDL):
                 return super(StoryCRUDL.List, self).lookup_field_link(context, field, obj)
 
         def get_images(self, obj):
-            return obj.images.count()
+            return obj.num_images
 
         def get_queryset(self, **kwargs):
             queryset = super(StoryCRUDL.List, self).get_queryset(**kwargs)
-            queryset = queryset.filter(org=self.derive_org())
+            queryset = queryset.filter(org=self.derive_org()).annotate(num_images=Count('images'))
 
             return queryset
 
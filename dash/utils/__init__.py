@@ -2,16 +2,26 @@ from __future__ import division, unicode_literals
 
 import calendar
 import datetime
-import json
+import math
 import pytz
 import random
 import six
+import threading
+import time
+import uuid
 
-from collections import OrderedDict
+from collections import defaultdict, OrderedDict
 from dateutil.relativedelta import relativedelta
+from django.conf import settings
 from django.core.cache import cache
+from django.db import connection, models, transaction
 from django.utils import timezone
+from django_redis import get_redis_connection
+from functools import wraps
 from itertools import islice
+from multiprocessing.pool import ThreadPool
+from redis.exceptions import LockError
+from .serializers import get_serializer, get_serializer_for_key
 
 
 def intersection(*args):
@@ -61,26 +71,236 @@ def filter_dict(d, keys):
     return {k: v for k, v in six.iteritems(d) if k in keys}
 
 
-def get_cacheable(cache_key, cache_ttl, calculate, recalculate=False):
+CACHEABLE_LOCK_KEY = 'cacheable-lock:%s'
+CACHEABLE_LOCK_TIMEOUT = 60
+
+# the key which marks a cached value as stored with its soft expiry time
+CACHEABLE_SOFT_TTL_MARKER = '__soft_ttl__'
+
+
+def get_cacheable(cache_key, cache_ttl, calculate, recalculate=False, serializer=None, soft_ttl=None, beta=None):
     """
-    Gets the result of a method call, using the given key and TTL as a cache
+    Gets the result of a method call, using the given key and TTL as a cache. Values are stored using the given
+    serializer name, or else the one configured for the key's prefix in the CACHEABLE_SERIALIZERS setting, or JSON.
+
+    If a soft TTL is given, a value older than that is considered stale. The first caller to see it stale recalculates
+    it whilst holding a lock, and other callers continue to get the stale value until the new one is stored. If beta is
+    also given, values may be considered stale before the soft TTL, with a probability that increases as the soft TTL
+    approaches and with the time the value took to calculate. A beta of 1 is a sensible default, larger values favour
+    earlier recalculation.
+
+    :param cache_key: the cache key
+    :param cache_ttl: the cache TTL in seconds after which the value is evicted
+    :param calculate: the method to calculate the value
+    :param recalculate: whether to always recalculate the value
+    :param serializer: the serializer name, e.g. 'json' or 'zlib-pickle'
+    :param soft_ttl: the TTL in seconds after which the value is stale and should be recalculated
+    :param beta: the weighting for probabilistic early recalculation of stale values
     """
+    serializer = get_serializer(serializer) if serializer else get_serializer_for_key(cache_key)
+
+    if soft_ttl is None:
+        if not recalculate:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                return _unwrap_cached(serializer.loads(cached))
+
+        calculated = calculate()
+        cache.set(cache_key, serializer.dumps(calculated), cache_ttl)
+
+        return calculated
+
     if not recalculate:
         cached = cache.get(cache_key)
         if cached is not None:
-            return json.loads(cached)
+            cached = serializer.loads(cached)
+
+            if not _is_stale(cached, beta):
+                return cached['value']
+
+            # only one caller recalculates a stale value, the others get the stale value until it's replaced
+            lock = get_redis_connection().lock(CACHEABLE_LOCK_KEY % cache_key, timeout=CACHEABLE_LOCK_TIMEOUT)
+            if not lock.acquire(blocking=False):
+                return _unwrap_cached(cached)
+
+            try:
+                return _calculate_cacheable(cache_key, cache_ttl, calculate, serializer, soft_ttl)
+            finally:
+                try:
+                    lock.release()
+                except LockError:  # pragma: no cover
+                    pass
+
+    return _calculate_cacheable(cache_key, cache_ttl, calculate, serializer, soft_ttl)
+
+
+def get_many_cacheable(cacheables, recalculate=False, num_threads=None):
+    """
+    Gets the results of several method calls, using the given keys and TTLs as a cache. Cached values are fetched in a
+    single round trip, and missing values are calculated and then stored with one round trip per distinct TTL.
+    Values are stored in the same way as get_cacheable without a soft TTL.
+
+    :param cacheables: dict of cache keys to tuples of cache TTL and calculate method
+    :param recalculate: whether to always recalculate the values
+    :param num_threads: the number of threads used to calculate missing values, or None to calculate them in turn
+    :return: dict of cache keys to values
+    """
+    results = {}
+
+    if not recalculate:
+        for key, cached in six.iteritems(cache.get_many(list(cacheables.keys()))):
+            results[key] = _unwrap_cached(get_serializer_for_key(key).loads(cached))
+
+    missing = [key for key in cacheables.keys() if key not in results]
+    if not missing:
+        return results
+
+    def calculate(key):
+        return cacheables[key][1]()
+
+    def calculate_in_thread(key):
+        # each thread has its own database connection which must be closed once it's done
+        try:
+            return calculate(key)
+        finally:
+            connection.close()
+
+    if num_threads and len(missing) > 1:
+        pool = ThreadPool(min(num_threads, len(missing)))
+        try:
+            calculated = pool.map(calculate_in_thread, missing)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        calculated = [calculate(key) for key in missing]
+
+    to_set_by_ttl = defaultdict(dict)
+    for key, value in zip(missing, calculated):
+        results[key] = value
+        to_set_by_ttl[cacheables[key][0]][key] = get_serializer_for_key(key).dumps(value)
+
+    for cache_ttl, to_set in six.iteritems(to_set_by_ttl):
+        cache.set_many(to_set, cache_ttl)
+
+    return results
+
+
+def _is_soft_ttl_cached(cached):
+    return isinstance(cached, dict) and cached.get(CACHEABLE_SOFT_TTL_MARKER) is True
+
+
+def _unwrap_cached(cached):
+    """
+    Gets the value from a cached value, which may have been stored with its soft expiry time
+    """
+    return cached['value'] if _is_soft_ttl_cached(cached) else cached
+
+
+def _is_stale(cached, beta):
+    """
+    Checks whether the given cached value with its soft expiry time is stale. With a beta, this uses the XFetch
+    algorithm to probabilistically consider values stale before they expire. Values which were stored without a soft
+    expiry time are always stale.
+    """
+    if not _is_soft_ttl_cached(cached):
+        return True
+
+    now = time.time()
+
+    if beta:
+        return now - cached['delta'] * beta * math.log(1.0 - random.random()) >= cached['expires']
 
+    return now >= cached['expires']
+
+
+def _calculate_cacheable(cache_key, cache_ttl, calculate, serializer, soft_ttl):
+    """
+    Calculates a value and stores it along with its soft expiry time and how long it took to calculate
+    """
+    start = time.time()
     calculated = calculate()
-    cache.set(cache_key, json.dumps(calculated), cache_ttl)
+    end = time.time()
+
+    cached = {CACHEABLE_SOFT_TTL_MARKER: True, 'value': calculated, 'expires': end + soft_ttl, 'delta': end - start}
+    cache.set(cache_key, serializer.dumps(cached), cache_ttl)
 
     return calculated
 
 
-def get_obj_cacheable(obj, attr_name, calculate, recalculate=False):
+OBJ_CACHE_ATTR = '_obj_cache'
+
+
+class ObjCache(object):
+    """
+    A memo store attached to an object, with per-entry TTLs and least recently used eviction
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def get(self, name, calculate, cache_ttl=None, recalculate=False):
+        with self.lock:
+            if not recalculate and name in self.entries:
+                value, expires = self.entries.pop(name)
+                if expires is None or expires > time.time():
+                    self.entries[name] = (value, expires)  # re-insert as most recently used
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+
+            calculated = calculate()
+            self.entries.pop(name, None)
+            self.entries[name] = (calculated, time.time() + cache_ttl if cache_ttl else None)
+
+            if self.max_entries:
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+            return calculated
+
+    def invalidate(self, prefix=''):
+        with self.lock:
+            for name in [n for n in self.entries.keys() if n.startswith(prefix)]:
+                del self.entries[name]
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
+
+    def __getstate__(self):
+        # memoized values aren't pickled or deep copied with their object
+        return {'max_entries': self.max_entries}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_entries'])
+
+
+def get_obj_cache(obj):
+    """
+    Gets the memo store for the given object, creating it if necessary. Its size is bounded by the
+    OBJ_CACHEABLE_MAX_ENTRIES setting.
+    """
+    obj_cache = obj.__dict__.get(OBJ_CACHE_ATTR)
+    if obj_cache is None:
+        obj_cache = ObjCache(getattr(settings, 'OBJ_CACHEABLE_MAX_ENTRIES', 100))
+        setattr(obj, OBJ_CACHE_ATTR, obj_cache)
+
+    return obj_cache
+
+
+def get_obj_cacheable(obj, attr_name, calculate, recalculate=False, cache_ttl=None):
     """
     Gets the result of a method call, using the given object and attribute name
-    as a cache
+    as a cache. If a TTL is given, the value is kept in the object's bounded memo
+    store instead and is recalculated once it expires.
     """
+    if cache_ttl is not None:
+        return get_obj_cache(obj).get(attr_name, calculate, cache_ttl, recalculate)
+
     if not recalculate and hasattr(obj, attr_name):
         return getattr(obj, attr_name)
 
@@ -90,6 +310,68 @@ def get_obj_cacheable(obj, attr_name, calculate, recalculate=False):
     return calculated
 
 
+def invalidate_obj_cacheable(obj, prefix=''):
+    """
+    Removes values from the object's memo store whose names start with the given prefix, or all values
+    """
+    get_obj_cache(obj).invalidate(prefix)
+
+
+def obj_cacheable(cache_ttl=None, name=None):
+    """
+    Decorator to memoize a method in the object's memo store, e.g.
+
+        @obj_cacheable(cache_ttl=60)
+        def get_stats(self, year):
+            ...
+
+    Values are stored by the method name and arguments, so can be invalidated by method name prefix.
+    :param cache_ttl: the TTL in seconds, or None for no expiry
+    :param name: the name to store values under, defaults to the method name
+    """
+    def _obj_cacheable(func):
+        base_name = name or func.__name__
+
+        @wraps(func)
+        def _decorator(self, *args, **kwargs):
+            entry_name = base_name
+            if args or kwargs:
+                entry_name += ':' + ':'.join([six.text_type(a) for a in args] +
+                                             ['%s=%s' % (k, v) for k, v in sorted(kwargs.items())])
+
+            return get_obj_cache(self).get(entry_name, lambda: func(self, *args, **kwargs), cache_ttl)
+
+        return _decorator
+    return _obj_cacheable
+
+
+def get_cache_version(key):
+    """
+    Gets the version token stored at the given cache key, which is used to invalidate other cached values. If it's
+    missing, e.g. because the cache was flushed, a new token is stored so that a previous version is never reused.
+    """
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key) or version
+
+    return version
+
+
+def invalidate_cache_version(key):
+    """
+    Replaces the version token stored at the given cache key with a new one. This is done immediately, so that the
+    current transaction sees its own changes, and again once the current transaction commits, so that anything cached
+    by other processes from the old rows in between is discarded.
+    """
+    def replace():
+        cache.set(key, uuid.uuid4().hex, None)
+
+    replace()
+    transaction.on_commit(replace)
+
+
 def datetime_to_ms(dt):
     """
     Converts a datetime to a millisecond accuracy timestamp
@@ -119,6 +401,59 @@ def get_month_range(d=None):
     return start, end
 
 
+def parse_tags(tags):
+    """
+    Parses a string of space separated tags into a list of unique lowercase tags
+    """
+    if not tags:
+        return []
+
+    return list(OrderedDict.fromkeys(tags.lower().split()))
+
+
+class TaggedManager(models.Manager):
+    """
+    Manager for models which store their parsed tags in an indexed tag_names field
+    """
+    def with_tag(self, tag):
+        return self.get_queryset().filter(tag_names__contains=[tag.strip().lower()])
+
+
+class TaggedContentMixin(object):
+    """
+    Mixin for models with tags and teasers, which keeps the tag_names and teasers fields in sync with the fields
+    they're calculated from whenever the model is saved, including when only some fields are being saved
+    """
+    def save(self, *args, **kwargs):
+        self.tag_names = parse_tags(self.tags)
+        self.teasers = self.calculate_teasers()
+
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = list(update_fields)
+            if 'tags' in update_fields:
+                update_fields.append('tag_names')
+            if 'summary' in update_fields or 'content' in update_fields:
+                update_fields.append('teasers')
+            kwargs['update_fields'] = update_fields
+
+        super(TaggedContentMixin, self).save(*args, **kwargs)
+
+
+def truncate_words(text, length, suffix):
+    """
+    Truncates text to the given number of space separated words, appending the suffix if it had that many words or
+    more. Only the first words of the text are scanned.
+    """
+    end = -1
+    for n in range(length):
+        end = text.find(' ', end + 1)
+        if end < 0:
+            return text + suffix if n == length - 1 else text
+
+    return text[:end] + suffix
+
+
 def chunks(iterable, size):
     """
     Splits a very large list into evenly sized chunks.
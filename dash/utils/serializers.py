@@ -0,0 +1,142 @@
+from __future__ import unicode_literals
+
+"""
+Serializers for values stored by get_cacheable
+"""
+
+import json
+import six
+import zlib
+
+from datetime import datetime
+from dateutil.parser import parse as parse_datetime
+from django.conf import settings
+from six.moves import cPickle as pickle
+
+
+DATETIME_TAG = '__datetime__'
+
+
+def _encode_datetime(obj):
+    if isinstance(obj, datetime):
+        return {DATETIME_TAG: obj.isoformat()}
+
+    raise TypeError("%r is not serializable" % obj)
+
+
+def _decode_datetime(obj):
+    if len(obj) == 1 and DATETIME_TAG in obj:
+        return parse_datetime(obj[DATETIME_TAG])
+
+    return obj
+
+
+class JsonSerializer(object):
+    """
+    Serializes values as JSON strings. Datetimes are encoded as tagged ISO8601 strings so that they round-trip.
+    """
+    def dumps(self, value):
+        return json.dumps(value, default=_encode_datetime)
+
+    def loads(self, data):
+        if isinstance(data, six.binary_type):
+            data = data.decode('utf-8')
+
+        return json.loads(data, object_hook=_decode_datetime)
+
+
+class PickleSerializer(object):
+    """
+    Serializes values with pickle, which is fast and supports most Python types, but should only be used for values
+    which are only read by the same code base.
+    """
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackSerializer(object):
+    """
+    Serializes values with msgpack, which is more compact and faster than JSON. Requires the msgpack package.
+    """
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def dumps(self, value):
+        return self.msgpack.packb(value, default=_encode_datetime, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, object_hook=_decode_datetime, raw=False)
+
+
+class CompressedSerializer(object):
+    """
+    Compresses the output of another serializer with zlib or lz4. The latter requires the lz4 package.
+    """
+    def __init__(self, serializer, compression='zlib'):
+        self.serializer = serializer
+
+        if compression == 'zlib':
+            self.compress, self.decompress = zlib.compress, zlib.decompress
+        elif compression == 'lz4':
+            import lz4.frame
+            self.compress, self.decompress = lz4.frame.compress, lz4.frame.decompress
+        else:
+            raise ValueError("Unsupported compression: %s" % compression)
+
+    def dumps(self, value):
+        data = self.serializer.dumps(value)
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+
+        return self.compress(data)
+
+    def loads(self, data):
+        return self.serializer.loads(self.decompress(data))
+
+
+SERIALIZER_FACTORIES = {
+    'json': JsonSerializer,
+    'pickle': PickleSerializer,
+    'msgpack': MsgpackSerializer,
+    'zlib-json': lambda: CompressedSerializer(JsonSerializer(), 'zlib'),
+    'zlib-pickle': lambda: CompressedSerializer(PickleSerializer(), 'zlib'),
+    'zlib-msgpack': lambda: CompressedSerializer(MsgpackSerializer(), 'zlib'),
+    'lz4-json': lambda: CompressedSerializer(JsonSerializer(), 'lz4'),
+    'lz4-pickle': lambda: CompressedSerializer(PickleSerializer(), 'lz4'),
+    'lz4-msgpack': lambda: CompressedSerializer(MsgpackSerializer(), 'lz4'),
+}
+
+# serializers are created on first use so that optional packages are only required if used
+_serializers = {}
+
+
+def get_serializer(name):
+    """
+    Gets the serializer with the given name, e.g. 'json' or 'zlib-pickle'
+    """
+    serializer = _serializers.get(name)
+    if serializer is None:
+        if name not in SERIALIZER_FACTORIES:
+            raise ValueError("Unknown serializer: %s" % name)
+
+        serializer = _serializers[name] = SERIALIZER_FACTORIES[name]()
+
+    return serializer
+
+
+def get_serializer_for_key(cache_key):
+    """
+    Gets the serializer for the given cache key, which is the one configured in the CACHEABLE_SERIALIZERS setting for
+    the longest matching key prefix, or JSON if there is no matching prefix
+    """
+    prefixes = getattr(settings, 'CACHEABLE_SERIALIZERS', {})
+
+    matches = [prefix for prefix in prefixes if cache_key.startswith(prefix)]
+    if matches:
+        return get_serializer(prefixes[max(matches, key=len)])
+
+    return get_serializer('json')
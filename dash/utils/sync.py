@@ -5,10 +5,20 @@ Sync support
 """
 
 import six
+import time
+import uuid
 
 from abc import ABCMeta, abstractmethod
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.db.models.functions import Cast
+from django_redis import get_redis_connection
 from enum import Enum
+from redis.exceptions import LockError
+
+from . import chunks
 
 
 class SyncOutcome(Enum):
@@ -18,6 +28,96 @@ class SyncOutcome(Enum):
     ignored = 4
 
 
+class BatchLock(object):
+    """
+    A lock on several Redis keys which are acquired and released together, each with a single Lua script call. Keys
+    are held in the same way as redis-py locks so a batch lock excludes single locks on any of the same keys.
+    """
+    ACQUIRE_SCRIPT = """
+    for i, key in ipairs(KEYS) do
+        if redis.call('exists', key) == 1 then
+            return 0
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        if tonumber(ARGV[2]) > 0 then
+            redis.call('set', key, ARGV[1], 'px', ARGV[2])
+        else
+            redis.call('set', key, ARGV[1])
+        end
+    end
+    return 1
+    """
+
+    RELEASE_SCRIPT = """
+    local released = 0
+    for i, key in ipairs(KEYS) do
+        if redis.call('get', key) == ARGV[1] then
+            redis.call('del', key)
+            released = released + 1
+        end
+    end
+    return released
+    """
+
+    def __init__(self, redis, keys, timeout=None, sleep=0.1, blocking_timeout=None):
+        """
+        :param redis: the Redis connection
+        :param keys: the keys to lock
+        :param timeout: the number of seconds after which the locks expire, or none to never expire
+        :param sleep: the number of seconds to sleep between attempts to acquire
+        :param blocking_timeout: the maximum number of seconds to spend trying to acquire, or none to try forever
+        """
+        self.redis = redis
+        self.keys = sorted(set(keys))
+        self.timeout = timeout
+        self.sleep = sleep
+        self.blocking_timeout = blocking_timeout
+        self.token = None
+
+        self._acquire = redis.register_script(self.ACQUIRE_SCRIPT)
+        self._release = redis.register_script(self.RELEASE_SCRIPT)
+
+    def acquire(self, blocking=True):
+        """
+        Acquires all of the keys, returning whether they were acquired
+        """
+        token = uuid.uuid1().hex
+        timeout_ms = int(self.timeout * 1000) if self.timeout else 0
+        stop_trying_at = time.time() + self.blocking_timeout if self.blocking_timeout is not None else None
+
+        while True:
+            if not self.keys or self._acquire(keys=self.keys, args=[token, timeout_ms]):
+                self.token = token
+                return True
+
+            if not blocking or (stop_trying_at is not None and time.time() > stop_trying_at):
+                return False
+
+            time.sleep(self.sleep)
+
+    def release(self):
+        """
+        Releases all of the keys which are still held by this lock, raising a LockError if any of them have expired or
+        been taken by another lock
+        """
+        if self.token is None:
+            raise LockError("Cannot release an unlocked lock")
+
+        token, self.token = self.token, None
+
+        if self.keys and self._release(keys=self.keys, args=[token]) < len(self.keys):
+            raise LockError("Cannot release a lock that's no longer owned")
+
+    def __enter__(self):
+        if self.acquire():
+            return self
+        raise LockError("Unable to acquire lock within the time specified")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
 @six.add_metaclass(ABCMeta)
 class BaseSyncer(object):
     """
@@ -29,6 +129,18 @@ class BaseSyncer(object):
     select_related = ()
     prefetch_related = ()
 
+    # whether sync_local_to_set should compute changes for chunks of remote objects in memory and apply them with bulk
+    # queries, rather than syncing each remote object individually. Bulk syncing bypasses model save methods and
+    # delete_local, so should only be enabled for models which don't depend on those. Each chunk is locked for the
+    # whole time it takes to apply it, so syncers which sync in bulk should also implement lock_key.
+    bulk_sync = False
+    bulk_chunk_size = 1000
+
+    # the expiry in seconds of locks acquired by lock_many when lock_key is implemented, which is extended by the per
+    # identity timeout for each locked identity since the work done under the lock grows with the number of them
+    batch_lock_timeout = 60
+    batch_lock_timeout_per_identity = 1
+
     def __init__(self, backend):
         self.backend = backend
 
@@ -57,6 +169,43 @@ class BaseSyncer(object):
         """
         return self.model.lock(org, identity)
 
+    def lock_key(self, org, identity):
+        """
+        Gets the Redis key locked by lock for the given identity. Implementing this allows lock_many to acquire locks
+        on many identities at once rather than one at a time.
+        :param org: the org
+        :param identity: the unique identity
+        :return: the key or none if unknown
+        """
+        return None
+
+    def can_lock_many(self, org, identities):
+        """
+        Whether lock_many can lock all of the given identity values with a single batch lock, which requires lock_key
+        to be implemented. Otherwise callers should lock and sync each identity in turn.
+        :param org: the org
+        :param identities: the unique identities
+        :return: whether they can be batch locked
+        """
+        return None not in [self.lock_key(org, identity) for identity in identities]
+
+    def lock_many(self, org, identities):
+        """
+        Gets a lock on all of the given identity values. If lock_key isn't implemented this falls back to holding the
+        individual lock on each identity, which is only used when syncing in bulk.
+        :param org: the org
+        :param identities: the unique identities
+        :return: the lock
+        """
+        keys = [self.lock_key(org, identity) for identity in identities]
+
+        if None in keys:
+            return _lock_each(org, self, identities)
+
+        timeout = self.batch_lock_timeout + self.batch_lock_timeout_per_identity * len(set(keys))
+
+        return BatchLock(get_redis_connection(), keys, timeout=timeout)
+
     def fetch_local(self, org, identity):
         """
         Fetches the local model instance with the given identity, returning none if it doesn't exist
@@ -64,14 +213,26 @@ class BaseSyncer(object):
         :param identity: the unique identity
         :return: the instance or none
         """
-        qs = self.fetch_all(org=org).filter(**{self.local_id_attr: identity})
+        return self._fetch_related(self.fetch_all(org=org).filter(**{self.local_id_attr: identity})).first()
+
+    def fetch_local_many(self, org, identities):
+        """
+        Fetches the local model instances with the given identities in a single query
+        :param org: the org
+        :param identities: the unique identities
+        :return: dict of identities to instances, which won't contain identities that don't exist locally
+        """
+        qs = self.fetch_all(org=org).filter(**{self.local_id_attr + '__in': identities})
 
+        return {self.identify_local(local): local for local in self._fetch_related(qs)}
+
+    def _fetch_related(self, qs):
         if self.select_related:
             qs = qs.select_related(*self.select_related)
         if self.prefetch_related:
             qs = qs.prefetch_related(*self.prefetch_related)
 
-        return qs.first()
+        return qs
 
     def fetch_all(self, org):
         """
@@ -112,46 +273,175 @@ class BaseSyncer(object):
         local.is_active = False
         local.save(update_fields=('is_active',))
 
+    def delete_locals(self, locals_qs):
+        """
+        Deletes all local instances in the given queryset, used instead of delete_local when syncing in bulk
+        :param locals_qs: the queryset of local instances
+        :return: the number of instances deleted
+        """
+        return locals_qs.update(is_active=False)
+
+
+def _resolve_outcome(org, syncer, existing, remote):
+    """
+    Determines what should happen to a local instance given the remote object, applying any changes to the local
+    instance without saving it
+
+    :param * org: the org
+    :param * syncer: the local model syncer
+    :param * existing: the existing local instance or none
+    :param * remote: the remote object
+    :return: tuple of the outcome, the unsaved instance to create, update or delete (if any), and the remote as kwargs
+    """
+    # derive kwargs for the local model (none return here means don't keep)
+    remote_as_kwargs = syncer.local_kwargs(org, remote)
+
+    # exists locally
+    if existing:
+        existing.org = org  # saves pre-fetching since we already have the org
 
-def sync_from_remote(org, syncer, remote):
+        if remote_as_kwargs:
+            if syncer.update_required(existing, remote, remote_as_kwargs) or not existing.is_active:
+                for field, value in six.iteritems(remote_as_kwargs):
+                    setattr(existing, field, value)
+
+                existing.is_active = True
+                return SyncOutcome.updated, existing, remote_as_kwargs
+
+        elif existing.is_active:  # exists locally, but shouldn't now to due to model changes
+            return SyncOutcome.deleted, existing, remote_as_kwargs
+
+    elif remote_as_kwargs:
+        return SyncOutcome.created, syncer.model(**remote_as_kwargs), remote_as_kwargs
+
+    return SyncOutcome.ignored, None, remote_as_kwargs
+
+
+def sync_from_remote(org, syncer, remote, prefetched=None):
     """
     Sync local instance against a single remote object
 
     :param * org: the org
     :param * syncer: the local model syncer
     :param * remote: the remote object
+    :param * prefetched: dict of identities to local instances from fetch_local_many, used instead of fetch_local
     :return: the outcome (created, updated or deleted)
     """
     identity = syncer.identify_remote(remote)
 
     with syncer.lock(org, identity):
+        return _sync_from_remote_locked(org, syncer, remote, identity, prefetched)
+
+
+def _sync_from_remote_locked(org, syncer, remote, identity, prefetched):
+    """
+    Sync local instance against a single remote object whose identity has already been locked
+    """
+    if prefetched is not None:
+        existing = prefetched.get(identity)
+    else:
         existing = syncer.fetch_local(org, identity)
 
-        # derive kwargs for the local model (none return here means don't keep)
-        remote_as_kwargs = syncer.local_kwargs(org, remote)
+    outcome, local, remote_as_kwargs = _resolve_outcome(org, syncer, existing, remote)
+
+    if outcome == SyncOutcome.created:
+        local.save(force_insert=True)
+
+        # so a repeat of this remote object in the same fetch is treated as an update
+        if prefetched is not None:
+            prefetched[identity] = local
+    elif outcome == SyncOutcome.updated:
+        local.save()
+    elif outcome == SyncOutcome.deleted:
+        syncer.delete_local(local)
 
-        # exists locally
-        if existing:
-            existing.org = org  # saves pre-fetching since we already have the org
+    return outcome
 
-            if remote_as_kwargs:
-                if syncer.update_required(existing, remote, remote_as_kwargs) or not existing.is_active:
-                    for field, value in six.iteritems(remote_as_kwargs):
-                        setattr(existing, field, value)
 
-                    existing.is_active = True
-                    existing.save()
-                    return SyncOutcome.updated
+@contextmanager
+def _lock_each(org, syncer, identities):
+    """
+    Holds the syncer's individual locks on all of the given identities. Every held lock is released even if releasing
+    some of them fails, after which the first failure is raised.
+    """
+    held = []
+    try:
+        # always acquire in the same order so that concurrent bulk syncs can't deadlock
+        for identity in sorted(set(identities)):
+            lock = syncer.lock(org, identity)
+            lock.__enter__()
+            held.append(lock)
+        yield
+    finally:
+        release_error = None
+        for lock in reversed(held):
+            try:
+                lock.__exit__(None, None, None)
+            except LockError as ex:
+                release_error = release_error or ex
+
+        if release_error:
+            raise release_error
+
+
+def _bulk_update(model, instances, field_names):
+    """
+    Updates the given fields of several model instances with a single UPDATE statement
+    """
+    if not instances:
+        return
+
+    updates = {}
+    for field in [model._meta.get_field(name) for name in field_names]:
+        whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in instances]
+        updates[field.name] = Cast(Case(*whens, output_field=field), field)
+
+    model.objects.filter(pk__in=[obj.pk for obj in instances]).update(**updates)
+
+
+def _sync_chunk_in_bulk(org, syncer, remotes, outcome_counts):
+    """
+    Syncs local instances against a chunk of remote objects using a fixed number of queries
+    """
+    # a remote object which is repeated in the chunk is only synced once, using its last occurrence
+    remotes_by_identity = OrderedDict()
+    for remote in remotes:
+        identity = syncer.identify_remote(remote)
+        if identity in remotes_by_identity:
+            del remotes_by_identity[identity]
+            outcome_counts[SyncOutcome.ignored] += 1
+        remotes_by_identity[identity] = remote
+
+    identities = list(remotes_by_identity.keys())
+
+    with syncer.lock_many(org, identities):
+        existing_by_identity = syncer.fetch_local_many(org, identities)
+
+        to_create, to_update, to_delete = [], [], []
+        update_fields = {'is_active'}
+
+        for identity, remote in six.iteritems(remotes_by_identity):
+            existing = existing_by_identity.get(identity)
+            outcome, local, remote_as_kwargs = _resolve_outcome(org, syncer, existing, remote)
+
+            if outcome == SyncOutcome.created:
+                to_create.append(local)
+            elif outcome == SyncOutcome.updated:
+                to_update.append(local)
+                update_fields.update(remote_as_kwargs.keys())
+            elif outcome == SyncOutcome.deleted:
+                to_delete.append(local)
+
+            outcome_counts[outcome] += 1
 
-            elif existing.is_active:  # exists locally, but shouldn't now to due to model changes
-                syncer.delete_local(existing)
-                return SyncOutcome.deleted
+        with transaction.atomic():
+            if to_create:
+                syncer.model.objects.bulk_create(to_create)
 
-        elif remote_as_kwargs:
-            syncer.model.objects.create(**remote_as_kwargs)
-            return SyncOutcome.created
+            _bulk_update(syncer.model, to_update, update_fields)
 
-    return SyncOutcome.ignored
+            if to_delete:
+                syncer.delete_locals(syncer.fetch_all(org).filter(pk__in=[local.pk for local in to_delete]))
 
 
 def sync_local_to_set(org, syncer, remote_set):
@@ -168,20 +458,40 @@ def sync_local_to_set(org, syncer, remote_set):
 
     remote_identities = set()
 
-    for remote in remote_set:
-        outcome = sync_from_remote(org, syncer, remote)
-        outcome_counts[outcome] += 1
+    if syncer.bulk_sync:
+        for remote_chunk in chunks(remote_set, syncer.bulk_chunk_size):
+            _sync_chunk_in_bulk(org, syncer, remote_chunk, outcome_counts)
 
-        remote_identities.add(syncer.identify_remote(remote))
+            remote_identities.update(syncer.identify_remote(remote) for remote in remote_chunk)
+    else:
+        for remote in remote_set:
+            outcome = sync_from_remote(org, syncer, remote)
+            outcome_counts[outcome] += 1
+
+            remote_identities.add(syncer.identify_remote(remote))
 
     # active local objects which weren't in the remote set need to be deleted
     active_locals = syncer.fetch_all(org).filter(is_active=True)
     delete_locals = active_locals.exclude(**{syncer.local_id_attr + '__in': remote_identities})
 
-    for local in delete_locals:
-        with syncer.lock(org, syncer.identify_local(local)):
-            syncer.delete_local(local)
-            outcome_counts[SyncOutcome.deleted] += 1
+    for local_chunk in chunks(delete_locals, syncer.bulk_chunk_size):
+        identities = [syncer.identify_local(local) for local in local_chunk]
+
+        if syncer.bulk_sync:
+            with syncer.lock_many(org, identities):
+                chunk_qs = syncer.fetch_all(org).filter(pk__in=[local.pk for local in local_chunk])
+                outcome_counts[SyncOutcome.deleted] += syncer.delete_locals(chunk_qs)
+
+        elif syncer.can_lock_many(org, identities):
+            with syncer.lock_many(org, identities):
+                for local in local_chunk:
+                    syncer.delete_local(local)
+                    outcome_counts[SyncOutcome.deleted] += 1
+        else:
+            for identity, local in zip(identities, local_chunk):
+                with syncer.lock(org, identity):
+                    syncer.delete_local(local)
+                    outcome_counts[SyncOutcome.deleted] += 1
 
     return (
         outcome_counts[SyncOutcome.created],
@@ -193,7 +503,9 @@ def sync_local_to_set(org, syncer, remote_set):
 
 def sync_local_to_changes(org, syncer, fetches, deleted_fetches, progress_callback=None):
     """
-    Sync local instances against iterators which return fetches of changed and deleted remote objects.
+    Sync local instances against iterators which return fetches of changed and deleted remote objects. If the syncer
+    implements lock_key, each fetch is locked at once and its local instances are loaded with one query using the
+    syncer's fetch_local_many, otherwise each remote object is locked and synced in turn.
 
     :param * org: the org
     :param * syncer: the local model syncer
@@ -206,9 +518,19 @@ def sync_local_to_changes(org, syncer, fetches, deleted_fetches, progress_callba
     outcome_counts = defaultdict(int)
 
     for fetch in fetches:
-        for remote in fetch:
-            outcome = sync_from_remote(org, syncer, remote)
-            outcome_counts[outcome] += 1
+        identities = [syncer.identify_remote(remote) for remote in fetch]
+
+        if syncer.can_lock_many(org, identities):
+            with syncer.lock_many(org, identities):
+                prefetched = syncer.fetch_local_many(org, identities)
+
+                for identity, remote in zip(identities, fetch):
+                    outcome = _sync_from_remote_locked(org, syncer, remote, identity, prefetched)
+                    outcome_counts[outcome] += 1
+        else:
+            for remote in fetch:
+                outcome = sync_from_remote(org, syncer, remote)
+                outcome_counts[outcome] += 1
 
         num_synced += len(fetch)
         if progress_callback:
@@ -216,13 +538,24 @@ def sync_local_to_changes(org, syncer, fetches, deleted_fetches, progress_callba
 
     # any item that has been deleted remotely should also be released locally
     for deleted_fetch in deleted_fetches:
-        for deleted_remote in deleted_fetch:
-            identity = syncer.identify_remote(deleted_remote)
-            with syncer.lock(org, identity):
-                existing = syncer.fetch_local(org, identity)
-                if existing:
-                    syncer.delete_local(existing)
-                    outcome_counts[SyncOutcome.deleted] += 1
+        identities = [syncer.identify_remote(deleted_remote) for deleted_remote in deleted_fetch]
+
+        if syncer.can_lock_many(org, identities):
+            with syncer.lock_many(org, identities):
+                prefetched = syncer.fetch_local_many(org, identities)
+
+                for identity in identities:
+                    existing = prefetched.get(identity)
+                    if existing:
+                        syncer.delete_local(existing)
+                        outcome_counts[SyncOutcome.deleted] += 1
+        else:
+            for identity in identities:
+                with syncer.lock(org, identity):
+                    existing = syncer.fetch_local(org, identity)
+                    if existing:
+                        syncer.delete_local(existing)
+                        outcome_counts[SyncOutcome.deleted] += 1
 
         num_synced += len(deleted_fetch)
         if progress_callback:
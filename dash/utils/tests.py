@@ -1,15 +1,23 @@
 from __future__ import unicode_literals
 
+import copy
 import json
 import pytz
+import six
+import time
+import zlib
 
 from datetime import datetime
 from django.core.cache import cache
+from django_redis import get_redis_connection
 from itertools import chain
+from mock import patch
 from . import (
-    intersection, union, random_string, filter_dict, get_cacheable, get_obj_cacheable, get_month_range,
-    chunks, is_dict_equal, datetime_to_ms, ms_to_datetime
+    intersection, union, random_string, filter_dict, get_cacheable, get_many_cacheable, get_obj_cacheable,
+    get_month_range, chunks, is_dict_equal, datetime_to_ms, ms_to_datetime, obj_cacheable, get_obj_cache,
+    invalidate_obj_cacheable, truncate_words, get_cache_version, invalidate_cache_version, CACHEABLE_LOCK_KEY
 )
+from .serializers import get_serializer, get_serializer_for_key
 from ..test import DashTest
 
 
@@ -57,6 +65,126 @@ class InitTest(DashTest):
         cache.set('test_key:2', '{"a":234,"b":"xyz"}', 60)
         self.assertEqual(get_cacheable('test_key:2', 60, calculate2), dict(a=234, b="xyz"))
 
+    def test_get_cacheable_serializers(self):
+        value = {'a': [1, 2], 'b': "abc", 'c': datetime(2014, 1, 2, 3, 4, 5, 678900, tzinfo=pytz.utc)}
+
+        def calculate():
+            return value
+
+        # datetimes round-trip with the default JSON serializer
+        self.assertEqual(get_cacheable('test_key:1', 60, calculate), value)
+        self.assertEqual(get_cacheable('test_key:1', 60, lambda: None), value)
+        self.assertIsInstance(cache.get('test_key:1'), six.text_type)
+
+        for serializer in ('pickle', 'zlib-json', 'zlib-pickle'):
+            cache_key = 'test_key:%s' % serializer
+            self.assertEqual(get_cacheable(cache_key, 60, calculate, serializer=serializer), value)
+            self.assertEqual(get_cacheable(cache_key, 60, lambda: None, serializer=serializer), value)
+
+        self.assertEqual(json.loads(zlib.decompress(cache.get('test_key:zlib-json')).decode('utf-8')),
+                         {'a': [1, 2], 'b': "abc", 'c': {'__datetime__': "2014-01-02T03:04:05.678900+00:00"}})
+
+        # serializer can be configured by key prefix
+        with self.settings(CACHEABLE_SERIALIZERS={'test_key:': 'pickle', 'test_key:zipped:': 'zlib-json'}):
+            self.assertEqual(get_serializer_for_key('test_key:zipped:1'), get_serializer('zlib-json'))
+            self.assertEqual(get_serializer_for_key('test_key:1'), get_serializer('pickle'))
+            self.assertEqual(get_serializer_for_key('other_key:1'), get_serializer('json'))
+
+            self.assertEqual(get_cacheable('test_key:zipped:1', 60, calculate), value)
+            self.assertEqual(get_serializer('zlib-json').loads(cache.get('test_key:zipped:1')), value)
+
+        self.assertRaises(ValueError, get_serializer, 'xxx')
+
+    def test_get_cacheable_soft_ttl(self):
+        calls = []
+
+        def calculate():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(get_cacheable('test_key:soft', 60, calculate, soft_ttl=10), 1)
+        self.assertEqual(get_cacheable('test_key:soft', 60, calculate, soft_ttl=10), 1)
+
+        # once the soft TTL has passed, one caller recalculates whilst others still get the stale value
+        with patch('dash.utils.time.time', return_value=time.time() + 11):
+            lock = get_redis_connection().lock(CACHEABLE_LOCK_KEY % 'test_key:soft', timeout=60)
+            lock.acquire()
+
+            self.assertEqual(get_cacheable('test_key:soft', 60, calculate, soft_ttl=10), 1)
+
+            lock.release()
+
+            self.assertEqual(get_cacheable('test_key:soft', 60, calculate, soft_ttl=10), 2)
+
+        self.assertEqual(get_cacheable('test_key:soft', 60, calculate, soft_ttl=10), 2)
+        self.assertEqual(get_cacheable('test_key:soft', 60, calculate, soft_ttl=10, recalculate=True), 3)
+
+        # with a beta, values can be recalculated before the soft TTL
+        with patch('dash.utils.random.random', return_value=0.999999):
+            self.assertEqual(get_cacheable('test_key:soft', 60, calculate, soft_ttl=10, beta=1.0), 3)
+
+            cache.delete('test_key:soft')
+
+            def calculate_slowly():
+                time.sleep(0.01)
+                return "SLOW"
+
+            self.assertEqual(get_cacheable('test_key:soft', 60, calculate_slowly, soft_ttl=10), "SLOW")
+            self.assertEqual(get_cacheable('test_key:soft', 60, calculate, soft_ttl=10, beta=1000.0), 4)
+
+        # values stored with a soft TTL can be read without one
+        self.assertEqual(get_cacheable('test_key:soft', 60, calculate), 4)
+        self.assertEqual(get_many_cacheable({'test_key:soft': (60, calculate)}), {'test_key:soft': 4})
+
+        # and values stored without a soft TTL are considered stale when read with one
+        cache.set('test_key:plain', json.dumps(["A", "B"]), 60)
+        self.assertEqual(get_cacheable('test_key:plain', 60, calculate, soft_ttl=10), 5)
+        self.assertEqual(get_cacheable('test_key:plain', 60, calculate, soft_ttl=10), 5)
+
+        # unless another caller is recalculating them
+        cache.set('test_key:plain', json.dumps(["A", "B"]), 60)
+        lock = get_redis_connection().lock(CACHEABLE_LOCK_KEY % 'test_key:plain', timeout=60)
+        lock.acquire()
+
+        self.assertEqual(get_cacheable('test_key:plain', 60, calculate, soft_ttl=10), ["A", "B"])
+
+        lock.release()
+
+    def test_get_many_cacheable(self):
+        calls = []
+
+        def calculate(value):
+            def _calculate():
+                calls.append(value)
+                return value
+            return _calculate
+
+        cache.set('test_key:1', json.dumps("CACHED"), 60)
+
+        cacheables = {
+            'test_key:1': (60, calculate("A")),
+            'test_key:2': (60, calculate({'b': 2})),
+            'test_key:3': (120, calculate(["C"])),
+        }
+        expected = {'test_key:1': "CACHED", 'test_key:2': {'b': 2}, 'test_key:3': ["C"]}
+
+        self.assertEqual(get_many_cacheable(cacheables), expected)
+        self.assertEqual(len(calls), 2)  # only misses are calculated
+
+        # values are stored as get_cacheable would store them
+        self.assertEqual(get_cacheable('test_key:2', 60, lambda: None), {'b': 2})
+        self.assertEqual(get_many_cacheable(cacheables), expected)
+        self.assertEqual(len(calls), 2)
+
+        # missing values can be calculated in a thread pool, which closes each thread's database connection
+        with patch('dash.utils.connection') as mock_connection:
+            self.assertEqual(get_many_cacheable(cacheables, recalculate=True, num_threads=3),
+                             {'test_key:1': "A", 'test_key:2': {'b': 2}, 'test_key:3': ["C"]})
+
+        self.assertEqual(mock_connection.close.call_count, 3)
+        self.assertEqual(len(calls), 5)
+        self.assertEqual(get_cacheable('test_key:1', 60, lambda: None), "A")
+
     def test_get_obj_cacheable(self):
         def calculate():
             return "CALCULATED"
@@ -66,6 +194,80 @@ class InitTest(DashTest):
         self.assertEqual(get_obj_cacheable(self, '_test_value', calculate), "CACHED")
         self.assertEqual(get_obj_cacheable(self, '_test_value', calculate, recalculate=True), "CALCULATED")
 
+    def test_obj_cacheable(self):
+        calls = []
+
+        class Thing(object):
+            @obj_cacheable(cache_ttl=60)
+            def get_value(self, arg=None):
+                calls.append(arg)
+                return len(calls)
+
+            @obj_cacheable()
+            def get_other(self):
+                calls.append(None)
+                return "OTHER"
+
+        thing = Thing()
+        self.assertEqual(thing.get_value(), 1)
+        self.assertEqual(thing.get_value(), 1)
+        self.assertEqual(thing.get_value("a"), 2)
+        self.assertEqual(thing.get_value(arg="a"), 3)
+        self.assertEqual(thing.get_other(), "OTHER")
+        self.assertEqual(get_obj_cache(thing).get_stats(), {'hits': 1, 'misses': 4, 'entries': 4})
+
+        # values expire after their TTL
+        with patch('dash.utils.time.time', return_value=time.time() + 61):
+            self.assertEqual(thing.get_value(), 5)
+            self.assertEqual(thing.get_other(), "OTHER")
+
+        # values can be invalidated by prefix
+        invalidate_obj_cacheable(thing, 'get_value')
+        self.assertEqual(thing.get_value(), 6)
+        self.assertEqual(thing.get_other(), "OTHER")
+        self.assertEqual(len(calls), 6)
+
+        invalidate_obj_cacheable(thing)
+        self.assertEqual(thing.get_other(), "OTHER")
+        self.assertEqual(len(calls), 7)
+
+        # least recently used values are evicted
+        with self.settings(OBJ_CACHEABLE_MAX_ENTRIES=2):
+            thing = Thing()
+            thing.get_value("a")
+            thing.get_value("b")
+            thing.get_value("a")
+            thing.get_value("c")
+            self.assertEqual(list(get_obj_cache(thing).entries.keys()), ["get_value:a", "get_value:c"])
+
+        # memoized values aren't copied with their object
+        self.assertEqual(get_obj_cache(copy.deepcopy(thing)).get_stats(), {'hits': 0, 'misses': 0, 'entries': 0})
+
+        # a TTL can also be given to get_obj_cacheable
+        self.assertEqual(get_obj_cacheable(thing, 'x', lambda: "X", cache_ttl=60), "X")
+        self.assertEqual(get_obj_cacheable(thing, 'x', lambda: "Y", cache_ttl=60), "X")
+        self.assertFalse(hasattr(thing, 'x'))
+
+    def test_get_cache_version(self):
+        version1 = get_cache_version('test:version')
+        self.assertEqual(get_cache_version('test:version'), version1)
+
+        invalidate_cache_version('test:version')
+        version2 = get_cache_version('test:version')
+        self.assertNotEqual(version2, version1)
+
+        # versions are replaced again once the current transaction commits
+        with patch('dash.utils.transaction.on_commit') as mock_on_commit:
+            invalidate_cache_version('test:version')
+
+        version3 = get_cache_version('test:version')
+        mock_on_commit.call_args[0][0]()
+        self.assertNotIn(get_cache_version('test:version'), (version2, version3))
+
+        # a flushed version isn't reused
+        cache.delete('test:version')
+        self.assertNotIn(get_cache_version('test:version'), (version1, version2))
+
     def test_datetime_to_ms(self):
         d1 = datetime(2014, 1, 2, 3, 4, 5, 678900, tzinfo=pytz.utc)
         self.assertEqual(datetime_to_ms(d1), 1388631845678)  # from http://unixtimestamp.50x.eu
@@ -93,6 +295,20 @@ class InitTest(DashTest):
         self.assertEqual(len(batches), 3)
         self.assertEqual(set(chain(*batches)), {1, 2, 3, 4, 5})
 
+    def test_truncate_words(self):
+        self.assertEqual(truncate_words("", 2, " .."), "")
+        self.assertEqual(truncate_words("one", 2, " .."), "one")
+        self.assertEqual(truncate_words("one two", 2, " .."), "one two ..")
+        self.assertEqual(truncate_words("one two three", 2, " .."), "one two ..")
+        self.assertEqual(truncate_words("one two three", 1, " .."), "one ..")
+
+        # matches splitting the whole text on spaces
+        for text in ("a b c d e", "a  b c ", " a b", "word " * 20):
+            for length in range(1, 8):
+                words = text.split(" ")
+                expected = text if len(words) < length else " ".join(words[:length]) + " .."
+                self.assertEqual(truncate_words(text, length, " .."), expected)
+
     def test_is_dict_equal(self):
         self.assertTrue(is_dict_equal({'a': 1, 'b': 2}, {'b': 2, 'a': 1}))
         self.assertFalse(is_dict_equal({'a': 1, 'b': 2}, {'a': 1, 'b': 3}))
@@ -9,6 +9,8 @@ from django_redis import get_redis_connection
 
 
 class Contact(models.Model):
+    LOCK_KEY = 'contact-lock:%d:%s'
+
     org = models.ForeignKey(Org)
 
     uuid = models.CharField(max_length=36, unique=True)
@@ -21,12 +23,15 @@ class Contact(models.Model):
 
     @classmethod
     def lock(cls, org, uuid):
-        return get_redis_connection().lock('contact-lock:%d:%s' % (org.pk, uuid), timeout=60)
+        return get_redis_connection().lock(cls.LOCK_KEY % (org.pk, uuid), timeout=60)
 
 
 class ContactSyncer(BaseSyncer):
     model = Contact
 
+    def lock_key(self, org, identity):
+        return Contact.LOCK_KEY % (org.pk, identity)
+
     def local_kwargs(self, org, remote):
         if remote.blocked:  # we don't store blocked contacts
             return None
@@ -3,7 +3,10 @@ from __future__ import unicode_literals
 
 from dash.test import DashTest, MockClientQuery
 from dash.utils import random_string
-from dash.utils.sync import SyncOutcome, sync_from_remote, sync_local_to_set, sync_local_to_changes
+from dash.utils.sync import SyncOutcome, BaseSyncer, sync_from_remote, sync_local_to_set, sync_local_to_changes
+from django_redis import get_redis_connection
+from mock import patch
+from redis.exceptions import LockError
 from temba_client.v2.types import Contact as TembaContact
 from .models import Contact, ContactSyncer, APIBackend
 
@@ -43,12 +46,68 @@ class SyncTest(DashTest):
         org_backend.backend_type = 'dash_test_runner.testapp.models.APIBackend'
         org_backend.save()
 
-        self.assertIsInstance(self.unicef.get_backend(), APIBackend)
+        backend = self.unicef.get_backend()
+        self.assertIsInstance(backend, APIBackend)
+        self.assertEqual(backend.backend, org_backend)
+
+        # backend instances are cached until the org's backends change
+        with self.assertNumQueries(0):
+            self.assertIs(self.unicef.get_backend(), backend)
+
+        org_backend.host = 'http://example.org/'
+        org_backend.save()
+
+        self.assertIsNot(self.unicef.get_backend(), backend)
+        self.assertEqual(self.unicef.get_backend().backend.host, 'http://example.org/')
+
+        # backend instances cached in this process aren't used after the cache is flushed
+        backend = self.unicef.get_backend()
+        get_redis_connection().flushdb()
+
+        self.assertIsNot(self.unicef.get_backend(), backend)
 
     def test_fetch_local(self):
         self.assertEqual(self.syncer.fetch_local(self.unicef, "C-001"), self.joe)
         self.assertEqual(self.syncer2.fetch_local(self.unicef, "CF-001"), self.joe2)
 
+    def test_fetch_local_many(self):
+        self.assertEqual(self.syncer.fetch_local_many(self.unicef, ["C-001", "CF-001", "C-999"]), {"C-001": self.joe})
+        self.assertEqual(self.syncer2.fetch_local_many(self.unicef, ["C-001", "CF-001"]), {"CF-001": self.joe2})
+        self.assertEqual(self.syncer.fetch_local_many(self.unicef, []), {})
+
+    def test_lock_many(self):
+        lock = self.syncer.lock_many(self.unicef, ["C-002", "C-001", "C-001"])
+        self.assertEqual(lock.keys, ["contact-lock:%d:C-001" % self.unicef.pk,
+                                     "contact-lock:%d:C-002" % self.unicef.pk])
+        self.assertEqual(lock.timeout, 62)
+
+        with lock:
+            # can't get a single lock on an identity held by the batch lock
+            self.assertFalse(Contact.lock(self.unicef, "C-002").acquire(blocking=False))
+
+            # or another batch lock which overlaps with it
+            self.assertFalse(self.syncer.lock_many(self.unicef, ["C-002", "C-003"]).acquire(blocking=False))
+
+            single_lock = Contact.lock(self.unicef, "C-003")
+            self.assertTrue(single_lock.acquire(blocking=False))
+            single_lock.release()
+
+        self.assertTrue(Contact.lock(self.unicef, "C-002").acquire(blocking=False))
+
+        # releasing a lock whose keys have expired is an error
+        lock = self.syncer.lock_many(self.unicef, ["C-006", "C-007"])
+        lock.acquire()
+        get_redis_connection().delete("contact-lock:%d:C-007" % self.unicef.pk)
+
+        self.assertRaises(LockError, lock.release)
+
+        # syncers which don't provide lock keys fall back to locking each identity
+        with patch.object(ContactSyncer, 'lock_key', BaseSyncer.lock_key):
+            with self.syncer.lock_many(self.unicef, ["C-004", "C-005"]):
+                self.assertFalse(Contact.lock(self.unicef, "C-005").acquire(blocking=False))
+
+            self.assertTrue(Contact.lock(self.unicef, "C-005").acquire(blocking=False))
+
     def test_local_kwargs(self):
         remote = TembaContact.create(uuid="C-002", name="Frank", blocked=False)
         kwargs = self.syncer.local_kwargs(self.unicef, remote)
@@ -138,6 +197,66 @@ class SyncTest(DashTest):
         Contact.objects.get(org=self.unicef, uuid="CF-003", name="Colm", backend=self.floip_backend, is_active=True)
         Contact.objects.get(org=self.unicef, uuid="CF-005", name="Edward", backend=self.floip_backend, is_active=True)
 
+    def test_sync_local_to_set_in_bulk(self):
+        Contact.objects.all().delete()  # start with no contacts...
+
+        self.syncer.bulk_sync = True
+        self.syncer.bulk_chunk_size = 2
+
+        remote_set = [
+            TembaContact.create(uuid="C-001", name="Anne", blocked=False),
+            TembaContact.create(uuid="C-002", name="Bob", blocked=False),
+            TembaContact.create(uuid="C-003", name="Colin", blocked=False),
+            TembaContact.create(uuid="C-004", name="Donald", blocked=True)
+        ]
+
+        self.assertEqual(sync_local_to_set(self.unicef, self.syncer, remote_set), (3, 0, 0, 1))
+        self.assertEqual(Contact.objects.count(), 3)
+
+        remote_set = [
+            # first contact removed
+            TembaContact.create(uuid="C-002", name="Bob", blocked=False),    # no change
+            TembaContact.create(uuid="C-003", name="Colm", blocked=False),   # changed name
+            TembaContact.create(uuid="C-005", name="Edward", blocked=False)  # new contact
+        ]
+
+        self.assertEqual(sync_local_to_set(self.unicef, self.syncer, remote_set), (1, 1, 1, 1))
+
+        self.assertEqual(Contact.objects.count(), 4)
+        Contact.objects.get(org=self.unicef, uuid="C-001", name="Anne", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="C-002", name="Bob", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-003", name="Colm", backend=self.rapidpro_backend, is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-005", name="Edward", is_active=True)
+
+        remote_set = [
+            TembaContact.create(uuid="C-001", name="Anne", blocked=False),   # re-activated
+            TembaContact.create(uuid="C-002", name="Bob", blocked=True),     # blocked so locally invalid
+            TembaContact.create(uuid="C-003", name="Colm", blocked=False),   # no change
+            TembaContact.create(uuid="C-005", name="Edward", blocked=False)  # no change
+        ]
+
+        self.assertEqual(sync_local_to_set(self.unicef, self.syncer, remote_set), (0, 1, 1, 2))
+
+        Contact.objects.get(org=self.unicef, uuid="C-001", name="Anne", is_active=True)
+        Contact.objects.get(org=self.unicef, uuid="C-002", name="Bob", is_active=False)
+
+        # a remote object repeated within a chunk is synced once using its last occurrence
+        remote_set = [
+            TembaContact.create(uuid="C-006", name="Fred", blocked=False),
+            TembaContact.create(uuid="C-006", name="Frederick", blocked=False),
+        ]
+
+        self.assertEqual(sync_local_to_set(self.unicef, self.syncer, remote_set), (1, 0, 3, 1))
+
+        Contact.objects.get(org=self.unicef, uuid="C-006", name="Frederick", is_active=True)
+        self.assertEqual(Contact.objects.filter(is_active=True).count(), 1)
+
+        # locals deleted in bulk are locked while they're deleted
+        with patch.object(ContactSyncer, 'lock_many', wraps=self.syncer.lock_many) as mock_lock_many:
+            self.assertEqual(sync_local_to_set(self.unicef, self.syncer, []), (0, 0, 1, 0))
+
+        mock_lock_many.assert_called_once_with(self.unicef, ["C-006"])
+
     def test_sync_local_to_changes(self):
         Contact.objects.all().delete()  # start with no contacts...
 
@@ -196,3 +315,60 @@ class SyncTest(DashTest):
         deleted_fetches = MockClientQuery([])
 
         self.assertEqual(sync_local_to_changes(self.unicef, self.syncer2, fetches, deleted_fetches), (0, 1, 1, 0))
+
+    @patch('dash_test_runner.testapp.models.ContactSyncer.fetch_local')
+    def test_sync_local_to_changes_prefetches(self, mock_fetch_local):
+        Contact.objects.all().delete()
+
+        fetches = MockClientQuery([
+            TembaContact.create(uuid="C-001", name="Anne", blocked=False),
+            TembaContact.create(uuid="C-001", name="Annie", blocked=False),  # repeated in same fetch
+        ])
+        deleted_fetches = MockClientQuery([
+            TembaContact.create(uuid="C-002", name=None, blocked=None),  # doesn't exist locally
+        ])
+
+        self.assertEqual(sync_local_to_changes(self.unicef, self.syncer, fetches, deleted_fetches), (1, 1, 0, 0))
+
+        Contact.objects.get(org=self.unicef, uuid="C-001", name="Annie", is_active=True)
+
+        mock_fetch_local.assert_not_called()
+
+    def test_sync_local_to_changes_without_lock_keys(self):
+        Contact.objects.all().delete()
+
+        fetches = MockClientQuery([
+            TembaContact.create(uuid="C-001", name="Anne", blocked=False),
+            TembaContact.create(uuid="C-002", name="Bob", blocked=False),
+        ])
+        deleted_fetches = MockClientQuery([
+            TembaContact.create(uuid="C-001", name=None, blocked=None),
+        ])
+
+        # syncers which don't provide lock keys lock and sync each remote object in turn
+        with patch.object(ContactSyncer, 'lock_key', BaseSyncer.lock_key):
+            with patch.object(ContactSyncer, 'lock_many') as mock_lock_many:
+                with patch.object(ContactSyncer, 'lock', wraps=self.syncer.lock) as mock_lock:
+                    self.assertEqual(sync_local_to_changes(self.unicef, self.syncer, fetches, deleted_fetches),
+                                     (2, 0, 1, 0))
+
+                    self.assertEqual(sync_local_to_set(self.unicef, self.syncer, []), (0, 0, 1, 0))
+
+        mock_lock_many.assert_not_called()
+        self.assertEqual(mock_lock.call_count, 4)
+
+        Contact.objects.get(org=self.unicef, uuid="C-001", is_active=False)
+        Contact.objects.get(org=self.unicef, uuid="C-002", is_active=False)
+
+    def test_lock_many_fallback_releases_all_locks(self):
+        with patch.object(ContactSyncer, 'lock_key', BaseSyncer.lock_key):
+            lock = self.syncer.lock_many(self.unicef, ["C-001", "C-002", "C-003"])
+
+            with self.assertRaises(LockError):
+                with lock:
+                    # the lock on C-002 expires whilst the others are held
+                    get_redis_connection().delete("contact-lock:%d:C-002" % self.unicef.pk)
+
+        # but the other locks have still been released
+        for identity in ("C-001", "C-003"):
+            self.assertTrue(Contact.lock(self.unicef, identity).acquire(blocking=False))
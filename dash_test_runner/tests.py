@@ -8,22 +8,27 @@ import pytz
 from dash.categories.models import Category, CategoryImage
 from dash.categories.fields import CategoryChoiceField
 from dash.dashblocks.models import DashBlockType, DashBlock, DashBlockImage
-from dash.dashblocks.templatetags.dashblocks import load_qbs
-from dash.orgs.middleware import SetOrgMiddleware
-from dash.orgs.models import Org, OrgBackground, Invitation, TaskState
-from dash.orgs.tasks import org_task
+from dash.dashblocks.templatetags.dashblocks import load_dashblocks_many, load_qbs
+from dash.orgs.cacheables import org_cacheable, get_org_cacheables, _registry
+from dash.orgs.middleware import SetOrgMiddleware, _host_orgs
+from dash.orgs.models import Org, OrgBackground, Invitation, TaskState, get_config_schema, get_group_perms
+from dash.orgs.models import ORG_BACKGROUNDS_CACHE_KEY
+from dash.orgs.tasks import org_task, trigger_org_task, extend_org_task_lock, refresh_org_cacheables, ORG_TASK_LOCK_KEY
 from dash.orgs.templatetags.dashorgs import display_time, national_phone
 from dash.orgs.context_processors import GroupPermWrapper
+from dash.orgs.forms import OrgForm
 from dash.stories.models import Story, StoryImage
 from django.conf import settings
-from django.contrib.auth.models import User, Group
+from django.contrib.auth.models import User, Group, Permission
 from django.core import mail
+from django.core.cache import cache
 from django.core.exceptions import DisallowedHost
 from django.core.urlresolvers import reverse, ResolverMatch
 from django.db.utils import IntegrityError
 from django.http import HttpRequest
 from dash.utils import random_string
 from django.utils.encoding import force_text
+from django_redis import get_redis_connection
 from mock import patch, Mock
 from smartmin.tests import SmartminTest
 from temba_client import __version__ as client_version
@@ -340,6 +345,55 @@ class SetOrgMiddlewareTest(DashTest):
         self.assertEqual(self.request.org, empty_subdomain_org)
         self.assertEqual(self.request.user.get_org(), empty_subdomain_org)
 
+    def test_host_org_caching(self):
+        ug_org = self.create_org('uganda', self.admin)
+
+        response = self.simulate_process('uganda.ureport.io', 'dash.test_test')
+        self.assertIsNone(response)
+        self.assertEqual(self.request.org, ug_org)
+
+        # subsequent requests to the same host don't hit the database
+        with self.assertNumQueries(0):
+            self.simulate_process('uganda.ureport.io', 'dash.test_test')
+            self.simulate_process('UGANDA.ureport.io', 'dash.test_test')
+
+        self.assertEqual(self.request.org, ug_org)
+
+        # and they get their own copy of the org
+        self.request.org.set_config('common.foo', "bar", commit=False)
+        self.simulate_process('uganda.ureport.io', 'dash.test_test')
+        self.assertIsNone(self.request.org.get_config('common.foo'))
+
+        # but changing an org invalidates the cache
+        ug_org.is_active = False
+        ug_org.save()
+
+        response = self.simulate_process('uganda.ureport.io', 'dash.test_test')
+        self.assertEqual(response.status_code, 302)
+        self.assertIsNone(self.request.org)
+
+        # hosts which don't resolve to an org aren't kept in this process
+        self.assertEqual(list(_host_orgs['orgs'].keys()), [])
+
+        # and the number of hosts which are is limited
+        ug_org.is_active = True
+        ug_org.save()
+
+        with patch('dash.orgs.middleware.ORG_HOST_MAX_CACHED', 0):
+            self.simulate_process('uganda.ureport.io', 'dash.test_test')
+            self.assertEqual(self.request.org, ug_org)
+            self.assertEqual(list(_host_orgs['orgs'].keys()), [])
+
+        self.simulate_process('uganda.ureport.io', 'dash.test_test')
+        self.assertEqual(len(_host_orgs['orgs']), 1)
+
+        # orgs cached in this process aren't used after the cache is flushed
+        Org.objects.filter(pk=ug_org.pk).update(name="Changed")
+        get_redis_connection().flushdb()
+
+        self.simulate_process('uganda.ureport.io', 'dash.test_test')
+        self.assertEqual(self.request.org.name, "Changed")
+
 
 class OrgContextProcessorTestcase(DashTest):
     def test_group_perms_wrapper(self):
@@ -359,6 +413,22 @@ class OrgContextProcessorTestcase(DashTest):
         self.assertFalse(viewers_wrapper["orgs"]["org_edit"])
         self.assertFalse(viewers_wrapper["orgs"]["org_home"])
 
+        # permissions are cached so subsequent wrappers don't need to query them
+        with self.assertNumQueries(0):
+            self.assertTrue(GroupPermWrapper(administrators)['orgs']['org_edit'])
+            self.assertIn('orgs.org_home', get_group_perms(editors))
+
+        # until the group's permissions change
+        org_edit = Permission.objects.get(content_type__app_label='orgs', codename='org_edit')
+        editors.permissions.add(org_edit)
+
+        self.assertTrue(GroupPermWrapper(editors)["orgs"]["org_edit"])
+        self.assertIn('orgs.org_edit', get_group_perms(editors))
+
+        editors.permissions.remove(org_edit)
+
+        self.assertFalse(GroupPermWrapper(editors)["orgs"]["org_edit"])
+
 
 class OrgBackendTest(DashTest):
     def setUp(self):
@@ -444,6 +514,32 @@ class OrgTest(DashTest):
                          'Token %s' % self.org.backends.filter(slug="rapidpro").first().api_token)
         self.assertEqual(client.headers['User-Agent'], 'rapidpro-python/%s' % client_version)
 
+        # backend connection details are cached so creating clients doesn't hit the database
+        org = Org.objects.get(pk=self.org.pk)
+
+        with self.assertNumQueries(0):
+            for cached_client in (self.org.get_temba_client(), org.get_temba_client()):
+                self.assertEqual(cached_client.root_url, 'http://example.com/api/v2')
+                self.assertEqual(cached_client.headers, client.headers)
+
+            self.assertEqual(self.org.get_backend_connection('rapidpro'),
+                             ('http://example.com/', org_backend.api_token))
+
+        self.assertIsNone(self.org.get_backend_connection('other'))
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.org.get_backend_connection('other'))
+
+        # renaming a backend invalidates what was cached under both its old and new slugs
+        org_backend.slug = 'other'
+        org_backend.save()
+
+        self.assertIsNone(self.org.get_backend_connection('rapidpro'))
+        self.assertEqual(self.org.get_backend_connection('other'), ('http://example.com/', org_backend.api_token))
+
+        org_backend.slug = 'rapidpro'
+        org_backend.save()
+
         self.assertEquals(self.org.get_user(), self.admin)
 
         viewer = self.create_user('Viewer')
@@ -459,6 +555,16 @@ class OrgTest(DashTest):
         self.assertEquals(self.org.get_user_org_group(viewer).name, "Viewers")
         self.assertIsNone(self.org.get_user_org_group(user))
 
+        # roles are memoized on the user object
+        with self.assertNumQueries(0):
+            self.assertEquals(self.org.get_user_org_group(editor).name, "Editors")
+            self.assertIsNone(self.org.get_user_org_group(user))
+
+        # a user with several roles gets the one with most permissions
+        self.org.editors.add(viewer)
+        self.assertEquals(self.org.get_user_org_group(User.objects.get(pk=viewer.pk)).name, "Editors")
+        self.org.editors.remove(viewer)
+
         org_users = self.org.get_org_users()
         self.assertEquals(len(org_users), 3)
         self.assertIn(self.admin, org_users)
@@ -504,6 +610,88 @@ class OrgTest(DashTest):
         org = Org.objects.get(pk=self.org.pk)  # refresh from db
         self.assertIsNone(org.get_config('test'))
 
+    def test_org_hierarchy(self):
+        nigeria = self.create_org('nigeria', self.admin)
+        lagos = self.create_org('lagos', self.admin)
+        lagos.country = nigeria
+        lagos.save()
+        ikeja = self.create_org('ikeja', self.admin)
+        ikeja.state = lagos
+        ikeja.save()
+
+        with self.assertNumQueries(1):
+            hierarchy = Org.objects.hierarchy()
+
+        with self.assertNumQueries(0):
+            self.assertIs(Org.objects.hierarchy(), hierarchy)
+
+            self.assertEqual(hierarchy.country_ids, [self.org.pk, nigeria.pk])
+            self.assertEqual(hierarchy.state_ids, [lagos.pk])
+            self.assertEqual(hierarchy.district_ids, [ikeja.pk])
+            self.assertEqual(hierarchy.get_parent_id(ikeja.pk), lagos.pk)
+            self.assertEqual(hierarchy.get_parent_id(lagos.pk), nigeria.pk)
+            self.assertIsNone(hierarchy.get_parent_id(nigeria.pk))
+            self.assertEqual(hierarchy.get_child_ids(nigeria.pk), [lagos.pk])
+            self.assertEqual(hierarchy.get_child_ids(ikeja.pk), [])
+            self.assertEqual(hierarchy.get_choices(hierarchy.state_ids), [(lagos.pk, "lagos")])
+
+        self.assertEqual(set(Org.objects.countries()), {self.org, nigeria})
+        self.assertEqual(set(Org.objects.states()), {lagos})
+        self.assertEqual(set(Org.objects.districts()), {ikeja})
+
+        ikeja = Org.objects.get(pk=ikeja.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(ikeja.is_district)
+            self.assertFalse(ikeja.is_state)
+            self.assertFalse(ikeja.is_country)
+
+        # hierarchy is reloaded when orgs change
+        lagos.name = "Lagos"
+        lagos.save()
+
+        hierarchy = Org.objects.hierarchy()
+        self.assertEqual(hierarchy.get_choices(hierarchy.state_ids), [(lagos.pk, "Lagos")])
+
+        form = OrgForm(instance=ikeja)
+        self.assertEqual(list(form.fields['state'].choices), [('', "---------"), (lagos.pk, "Lagos")])
+
+        # and after the cache is flushed, even if it was loaded after a previous flush
+        get_redis_connection().flushdb()
+        Org.objects.hierarchy()
+
+        Org.objects.filter(pk=lagos.pk).update(name="Lagos State")
+        get_redis_connection().flushdb()
+
+        hierarchy = Org.objects.hierarchy()
+        self.assertEqual(hierarchy.get_choices(hierarchy.state_ids), [(lagos.pk, "Lagos State")])
+
+    def test_get_all_config(self):
+        self.org.set_config('has_flag', 1, commit=False)
+        self.org.set_config('rapidpro.reporter_group', "Reporters", commit=False)
+
+        config = self.org.get_all_config()
+        self.assertEqual(config['common.shortcode'], None)
+        self.assertEqual(config['common.has_flag'], 1)
+        self.assertEqual(config['rapidpro.reporter_group'], "Reporters")
+        self.assertEqual(config['rapidpro.born_label'], None)
+
+        schema = get_config_schema()
+        self.assertIs(schema, get_config_schema())
+
+        fields = schema.get_fields(['rapidpro'])
+        self.assertEqual(fields[0].key, 'common.shortcode')
+        self.assertEqual(len(fields), len(settings.ORG_CONFIG_FIELDS) + len(settings.BACKENDS_ORG_CONFIG_FIELDS))
+        self.assertTrue(fields[-1].is_visible(False))
+        self.assertFalse(fields[-1].is_editable(False))
+        self.assertTrue(fields[-1].is_editable(True))
+
+        # schema is recompiled if settings change
+        with self.settings(ORG_CONFIG_FIELDS=[dict(name='has_flag', field=dict())]):
+            self.assertEqual([f.key for f in get_config_schema().get_fields()], ['common.has_flag'])
+            self.assertIs(self.org.get_all_config()['common.has_flag'], True)
+
+        self.assertEqual(get_config_schema().get_fields()[0].key, 'common.shortcode')
+
     def test_build_host_link(self):
         with self.settings(HOSTNAME='localhost:8000'):
             self.assertEqual(self.org.build_host_link(), 'http://uganda.localhost:8000')
@@ -832,6 +1020,16 @@ class OrgTest(DashTest):
         self.assertTrue(self.org in response.context['orgs'])
         self.assertEquals(response.context['orgs'][0].host, "http://uganda.ureport.io")
 
+        # orgs are cached until any org changes
+        with self.assertNumQueries(0):
+            response = self.client.get(chooser_url)
+            self.assertEquals(response.context['orgs'][0].host, "http://uganda.ureport.io")
+
+        # but not shared between sites with different hosts
+        with self.settings(HOSTNAME='ureport.example.com', SESSION_COOKIE_SECURE=True):
+            response = self.client.get(chooser_url)
+            self.assertEquals(response.context['orgs'][0].host, "https://uganda.ureport.example.com")
+
         self.org2 = self.create_org('nigeria', self.admin)
 
         response = self.client.get(chooser_url)
@@ -1226,6 +1424,45 @@ class OrgBackgroundTest(DashTest):
 
         self.clear_uploads()
 
+    def test_get_backgrounds(self):
+        pattern1 = OrgBackground.objects.create(org=self.uganda, name="Pattern 1", background_type='P', image='x.jpg',
+                                                created_by=self.admin, modified_by=self.admin)
+        pattern2 = OrgBackground.objects.create(org=self.uganda, name="Pattern 2", background_type='P', image='y.jpg',
+                                                created_by=self.admin, modified_by=self.admin)
+        OrgBackground.objects.create(org=self.nigeria, name="Banner", background_type='B', image='z.jpg',
+                                     created_by=self.admin, modified_by=self.admin)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.uganda.get_backgrounds(), {'P': pattern2})
+            self.assertEqual(self.uganda.get_backgrounds(), {'P': pattern2})
+
+        # other instances of the same org use the shared cache
+        uganda = Org.objects.get(pk=self.uganda.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(uganda.get_backgrounds(), {'P': pattern2})
+
+        pattern2.is_active = False
+        pattern2.save()
+
+        self.assertEqual(Org.objects.get(pk=self.uganda.pk).get_backgrounds(), {'P': pattern1})
+
+        banner = OrgBackground.objects.create(org=self.uganda, name="Banner", background_type='B', image='z.jpg',
+                                              created_by=self.admin, modified_by=self.admin)
+
+        uganda = Org.objects.get(pk=self.uganda.pk)
+        self.assertEqual(uganda.get_backgrounds(), {'P': pattern1, 'B': banner})
+
+        # backgrounds cached again before the change commits are deleted once it does
+        with patch('dash.orgs.models.transaction.on_commit') as mock_on_commit:
+            pattern1.delete()
+
+            uganda = Org.objects.get(pk=self.uganda.pk)
+            self.assertEqual(uganda.get_backgrounds(), {'B': banner})
+
+        self.assertIsNotNone(cache.get(ORG_BACKGROUNDS_CACHE_KEY % self.uganda.pk))
+        mock_on_commit.call_args[0][0]()
+        self.assertIsNone(cache.get(ORG_BACKGROUNDS_CACHE_KEY % self.uganda.pk))
+
 
 def test_over_time_window(org, started_on, prev_started_on):
     """The org task function below will be transformed by @org_task decorator, so easier to mock this"""
@@ -1242,6 +1479,12 @@ def test_org_task_2(org, started_on, prev_started_on):
     return test_over_time_window(org, started_on, prev_started_on)
 
 
+@org_task('test-task-3', lock_timeout=10)
+def test_org_task_3(org):
+    extend_org_task_lock(org, 'test-task-3', 20)
+    return {'ttl': get_redis_connection().ttl(ORG_TASK_LOCK_KEY % (org.pk, 'test-task-3'))}
+
+
 class OrgTaskTest(DashTest):
     def setUp(self):
         super(OrgTaskTest, self).setUp()
@@ -1351,6 +1594,147 @@ class OrgTaskTest(DashTest):
 
         mock_over_time_window.assert_called_once_with(self.org, state2.started_on, state6.started_on)
 
+    def test_org_task_locking(self):
+        r = get_redis_connection()
+
+        # task is skipped immediately if another worker holds its lock
+        lock = r.lock(ORG_TASK_LOCK_KEY % (self.org.pk, 'test-task-1'), timeout=10)
+        lock.acquire()
+
+        test_org_task_1(self.org.pk)
+
+        self.assertFalse(TaskState.objects.filter(org=self.org, task_key='test-task-1').exists())
+
+        lock.release()
+
+        test_org_task_1(self.org.pk)
+
+        self.assertTrue(TaskState.objects.get(org=self.org, task_key='test-task-1').has_ever_run())
+        self.assertFalse(r.exists(ORG_TASK_LOCK_KEY % (self.org.pk, 'test-task-1')))
+
+        # running tasks can extend their own lock
+        test_org_task_3(self.org.pk)
+
+        state = TaskState.objects.get(org=self.org, task_key='test-task-3')
+        self.assertGreater(state.get_last_results()['ttl'], 10)
+        self.assertFalse(r.exists(ORG_TASK_LOCK_KEY % (self.org.pk, 'test-task-3')))
+
+        # but can't extend the lock of a task that isn't running
+        self.assertRaises(ValueError, extend_org_task_lock, self.org, 'test-task-3', 20)
+
+    def test_org_task_signature(self):
+        def invalid_task(org, since):
+            pass
+
+        # task signature is checked once when the task is declared
+        self.assertRaises(ValueError, org_task('test-task-4'), invalid_task)
+
+    def test_refresh_org_cacheables(self):
+        calls = []
+
+        @org_cacheable('test-cacheable:%d', 60)
+        def test_cacheable(org):
+            calls.append(org.pk)
+            return len(calls)
+
+        @org_cacheable('test-cacheable-failing:%d', 60)
+        def test_cacheable_failing(org):
+            raise ValueError("Boom")
+
+        @org_cacheable('test-cacheable-persistent:%d', None)
+        def test_cacheable_persistent(org):
+            return "P"
+
+        self.addCleanup(_registry.pop, 'test-cacheable:%d')
+        self.addCleanup(_registry.pop, 'test-cacheable-failing:%d')
+        self.addCleanup(_registry.pop, 'test-cacheable-persistent:%d')
+
+        for cacheable in (test_cacheable, test_cacheable_failing, test_cacheable_persistent):
+            self.addCleanup(cache.delete, cacheable.get_key(self.org))
+
+        self.assertIn(test_cacheable, get_org_cacheables())
+        self.assertEqual(test_cacheable.get(self.org), 1)
+        self.assertEqual(test_cacheable.get(self.org), 1)
+        self.assertEqual(test_cacheable_persistent.get(self.org), "P")
+
+        # value isn't close enough to expiry to be refreshed, value without expiry is never refreshed, failing
+        # cacheable is missing so is refreshed
+        refresh_org_cacheables(self.org.pk)
+
+        state = TaskState.objects.get(org=self.org, task_key='refresh-org-cacheables')
+        results = json.loads(state.last_results)
+        self.assertEqual(results['skipped'], ['test-cacheable:%d', 'test-cacheable-persistent:%d'])
+        self.assertEqual(results['failed'], ['test-cacheable-failing:%d'])
+        self.assertFalse(state.is_failing)
+        self.assertEqual(test_cacheable.get(self.org), 1)
+
+        # once close to expiry, value is recalculated
+        with patch('django_redis.cache.RedisCache.ttl', return_value=10):
+            refresh_org_cacheables(self.org.pk)
+
+        results = json.loads(TaskState.objects.get(org=self.org, task_key='refresh-org-cacheables').last_results)
+        self.assertEqual(list(results['refreshed'].keys()), ['test-cacheable:%d'])
+        self.assertEqual(test_cacheable.get(self.org), 2)
+
+
+class TriggerOrgTaskTest(DashTest):
+    def setUp(self):
+        super(TriggerOrgTaskTest, self).setUp()
+
+        self.uganda = self.create_org("uganda", self.admin)
+        self.nigeria = self.create_org("nigeria", self.admin)
+        self.rwanda = self.create_org("rwanda", self.admin)
+        self.kenya = self.create_org("kenya", self.admin)
+
+        self.kenya.is_active = False
+        self.kenya.save()
+
+    @patch('dash.orgs.tasks.group')
+    @patch('dash.orgs.tasks.signature')
+    def test_trigger_org_task(self, mock_signature, mock_group):
+        task_name = 'dash_test_runner.tests.test_org_task_1'
+        org_ids = sorted([self.uganda.pk, self.nigeria.pk, self.rwanda.pk])
+
+        self.assertEqual(trigger_org_task(task_name), 3)
+        self.assertEqual(sorted(TaskState.objects.filter(task_key='test-task-1').values_list('org_id', flat=True)),
+                         org_ids)
+
+        # creating states which already exist, e.g. because a sub-task started concurrently, is a no-op
+        TaskState.objects.filter(org=self.uganda, task_key='test-task-1').update(is_failing=True)
+        TaskState.get_or_create_for_orgs(org_ids, 'test-task-1')
+        TaskState.get_or_create_for_orgs([], 'test-task-1')
+
+        self.assertEqual(TaskState.objects.filter(task_key='test-task-1').count(), 3)
+        self.assertTrue(TaskState.objects.get(org=self.uganda, task_key='test-task-1').is_failing)
+        self.assertEqual(sorted(c[1]['args'][0] for c in mock_signature.call_args_list), org_ids)
+
+        apply_calls = mock_signature.return_value.apply_async.call_args_list
+        self.assertEqual(len(apply_calls), 3)
+        self.assertEqual([c[1]['queue'] for c in apply_calls], ['celery', 'celery', 'celery'])
+        self.assertNotIn('countdown', apply_calls[0][1])
+
+        # all sub-tasks are published with the same producer
+        self.assertEqual(len({c[1]['producer'] for c in apply_calls}), 1)
+
+        mock_signature.reset_mock()
+
+        # spread sub-tasks over a minute
+        self.assertEqual(trigger_org_task(task_name, queue='sync', spread_over=60), 3)
+
+        apply_calls = mock_signature.return_value.apply_async.call_args_list
+        self.assertEqual([c[1]['countdown'] for c in apply_calls], [0, 20, 40])
+        self.assertEqual([c[1]['queue'] for c in apply_calls], ['sync', 'sync', 'sync'])
+
+        mock_signature.reset_mock()
+
+        # or publish them in groups of 2 orgs
+        self.assertEqual(trigger_org_task(task_name, spread_over=60, batch_size=2), 3)
+        self.assertEqual(mock_signature.call_count, 3)
+        self.assertEqual(mock_group.call_count, 2)
+
+        apply_calls = mock_group.return_value.apply_async.call_args_list
+        self.assertEqual([c[1]['countdown'] for c in apply_calls], [0, 30])
+
 
 class TaskCRUDLTest(DashTest):
     def setUp(self):
@@ -1681,6 +2065,18 @@ class StoryTest(DashTest):
         self.assertEquals(self.story.long_teaser(), "summary " * 100 + "..")
         self.assertEquals(self.story.short_teaser(), "summary " * 40 + "..")
 
+        # teasers are stored when saved so loaded stories don't recalculate them
+        self.story.summary = "new summary"
+        self.story.save(update_fields=('summary',))
+
+        story = Story.objects.get(pk=self.story.pk)
+        self.assertEqual(story.teasers, {'long': "new summary", 'short': "new summary"})
+        self.assertEquals(story.long_teaser(), "new summary")
+
+        # but are calculated if missing
+        story.teasers = {}
+        self.assertEquals(story.short_teaser(), "new summary")
+
         self.assertIsNone(self.story.get_written_by())
 
         self.admin.last_name = "Musk"
@@ -1749,6 +2145,29 @@ class StoryTest(DashTest):
         self.assertFalse(self.story.get_category_image())
         self.assertFalse(self.story.get_image(), 'categories/some_image.jpg')
 
+        # images can be resolved for several stories with a constant number of queries
+        self.health_uganda.is_active = True
+        self.health_uganda.save()
+
+        story_image_1.is_active = True
+        story_image_1.save()
+
+        story2 = Story.objects.create(title="Story 2", content="Content", category=self.health_uganda,
+                                      org=self.uganda, created_by=self.admin, modified_by=self.admin)
+        story3 = Story.objects.create(title="Story 3", content="Content",
+                                      org=self.uganda, created_by=self.admin, modified_by=self.admin)
+
+        with self.assertNumQueries(4):
+            stories = Story.objects.filter(pk__in=[self.story.pk, story2.pk, story3.pk]).order_by('pk')
+            stories = Story.prefetch_images(list(stories))
+
+        with self.assertNumQueries(0):
+            self.assertEquals([s.get_image() for s in stories],
+                              ['stories/someimage.jpg', 'categories/some_image.jpg', None])
+            self.assertEquals([s.get_category_image() for s in stories],
+                              ['categories/some_image.jpg', 'categories/some_image.jpg', None])
+            self.assertEquals(list(stories[0].get_featured_images()), [story_image_1])
+
     def test_create_story(self):
         create_url = reverse('stories.story_create')
 
@@ -1805,6 +2224,9 @@ class StoryTest(DashTest):
         self.assertEquals(story.audio_link, 'http://example.com/foo.mp3')
         self.assertEquals(story.video_id, 'yt_id')
         self.assertEquals(story.tags, ' first second third ')
+        self.assertEquals(story.tag_names, ['first', 'second', 'third'])
+        self.assertEquals(list(Story.objects.with_tag('SECOND')), [story])
+        self.assertEquals(list(Story.objects.with_tag('sec')), [])
 
         nigeria_law = Category.objects.create(name="Law", org=self.nigeria, is_active=False,
                                               created_by=self.admin, modified_by=self.admin)
@@ -2223,6 +2645,18 @@ class DashBlockTest(DashTest):
         self.assertEquals(dashblock1.long_summary_teaser(), 'cd ' * 100 + "...")
         self.assertEquals(dashblock1.short_summary_teaser(), 'cd ' * 40 + "...")
 
+        dashblock1 = DashBlock.objects.get(pk=dashblock1.pk)
+        self.assertEqual(set(dashblock1.teasers.keys()),
+                         {'long_content', 'short_content', 'long_summary', 'short_summary'})
+        self.assertEquals(dashblock1.teasers['short_summary'], 'cd ' * 40 + "...")
+
+        dashblock1.content = 'ef ' * 50
+        dashblock1.save(update_fields=('content',))
+
+        dashblock1 = DashBlock.objects.get(pk=dashblock1.pk)
+        self.assertEquals(dashblock1.long_content_teaser(), 'ef ' * 50)
+        self.assertEquals(dashblock1.short_content_teaser(), 'ef ' * 40 + "...")
+
     def test_create_dashblock(self):
         create_url = reverse('dashblocks.dashblock_create')
 
@@ -2371,6 +2805,13 @@ class DashBlockTest(DashTest):
         self.assertEquals(updated_dashblock.dashblock_type, self.type_foo)
         self.assertEquals(updated_dashblock.org, self.uganda)
         self.assertEquals(updated_dashblock.tags, ' gasabo kacyiru umujyi ')
+        self.assertEquals(updated_dashblock.tag_names, ['gasabo', 'kacyiru', 'umujyi'])
+        self.assertEquals(list(DashBlock.objects.with_tag('Kacyiru')), [updated_dashblock])
+
+        # tag names are kept in sync when only tags are saved
+        updated_dashblock.tags = ' nyarugenge '
+        updated_dashblock.save(update_fields=('tags',))
+        self.assertEquals(DashBlock.objects.get(pk=updated_dashblock.pk).tag_names, ['nyarugenge'])
         self.assertEquals(updated_dashblock.title, 'kigali')
         self.assertEquals(updated_dashblock.content, 'kacyiru')
 
@@ -2625,6 +3066,69 @@ class DashBlockTest(DashTest):
         self.assertFalse(dashblock3 in context['foo'])
         self.assertFalse(dashblock4 in context['foo'])
 
+        dashblock4.priority = 2
+        dashblock4.save()
+
+        image = DashBlockImage.objects.create(dashblock=dashblock1, image='dashblock_images/image.jpg', caption="Image",
+                                              width=10, height=10, created_by=self.admin, modified_by=self.admin)
+
+        # blocks are cached with their images
+        self.assertEquals(load_qbs(context, self.uganda, 'foo'), '')
+        self.assertEquals(context['foo'], [dashblock4, dashblock1])
+
+        with self.assertNumQueries(0):
+            self.assertEquals(load_qbs(context, self.uganda, 'foo'), '')
+            self.assertEquals(load_qbs(context, self.uganda, 'foo', 'KACYIRU'), '')
+            self.assertEquals(context['foo'], [dashblock4])
+            self.assertEquals(load_qbs(context, self.uganda, 'foo'), '')
+            self.assertEquals(context['foo'], [dashblock4, dashblock1])
+            self.assertEquals(context['foo'][1].sorted_images(), [image])
+            self.assertEquals(force_text(context['foo'][1]), "First")
+
+        # and invalidated when blocks, images or types change
+        image.is_active = False
+        image.save()
+
+        self.assertEquals(load_qbs(context, self.uganda, 'foo'), '')
+        self.assertEquals(context['foo'][1].sorted_images(), [])
+
+        self.type_foo.slug = 'foo2'
+        self.type_foo.save()
+
+        self.assertNotEquals(load_qbs(context, self.uganda, 'foo'), '')
+        self.assertEquals(load_qbs(context, self.uganda, 'foo2'), '')
+        self.assertEquals(context['foo2'], [dashblock4, dashblock1])
+
+        # losing the version doesn't bring back lists cached under an earlier one
+        cache.delete('dashblocks-cache-version')
+        self.assertEquals(load_qbs(context, self.uganda, 'foo2'), '')
+
+        DashBlock.objects.filter(pk=dashblock4.pk).update(is_active=False)
+        cache.delete('dashblocks-cache-version')
+
+        self.assertEquals(load_qbs(context, self.uganda, 'foo2'), '')
+        self.assertEquals(context['foo2'], [dashblock1])
+
+        dashblock4.save()
+
+        # several slugs can be loaded at once
+        context = dict()
+        with self.assertNumQueries(3):
+            self.assertEquals(load_dashblocks_many(context, self.uganda, 'foo2', 'bar'), '')
+
+        self.assertEquals(context, {'foo2': [dashblock4, dashblock1], 'bar': [dashblock2]})
+
+        with self.assertNumQueries(0):
+            self.assertEquals(load_dashblocks_many(context, self.uganda, 'foo2', 'bar', tag='gasabo'), '')
+            self.assertEquals(context, {'foo2': [dashblock1], 'bar': []})
+
+        self.assertEquals(load_dashblocks_many(context, self.uganda, 'foo2', 'invalid_slug'),
+                          getattr(settings,
+                                  'DASHBLOCK_STRING_IF_INVALID',
+                                  '<b><font color="red">DashBlockType with slug: %s not found</font></b>'
+                                  ) % 'invalid_slug')
+        self.assertEquals(load_dashblocks_many(context, None, 'foo2'), '')
+
 
 class TemplateTagsTest(DashTest):
     def test_if_url(self):